@@ -0,0 +1,65 @@
+"""
+Times the kdtree and pyresample Gaussian gridding engines on a synthetic day of
+along track data gridded onto the 0.5 degree global grid, and reports how far
+apart their results are.
+
+    python benchmarks/bench_gauss_kdtree.py [n_points] [neighbours] [threads]
+"""
+import sys
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', UserWarning)
+    import pyresample as pr
+    from pyresample.kd_tree import resample_gauss
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from gauss_kdtree import gauss_grid_kdtree, lonlat_to_xyz  # noqa: E402
+
+
+def best_of(func, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(n_points=300000, neighbours=500, threads=4):
+    rng = np.random.default_rng(0)
+    lons = rng.uniform(-180, 180, n_points)
+    lats = np.rad2deg(np.arcsin(rng.uniform(-np.sin(np.deg2rad(66)), np.sin(np.deg2rad(66)), n_points)))
+    values = 0.1 * np.sin(np.deg2rad(lats) * 3) + rng.normal(0, 0.02, n_points)
+
+    target_lons, target_lats = np.meshgrid(np.arange(-179.75, 180, 0.5), np.arange(-89.75, 90, 0.5))
+    target_lons, target_lats = target_lons.ravel(), target_lats.ravel()
+    params = {'roi': 6e5, 'sigma': 1e5, 'neighbours': neighbours}
+
+    source = pr.geometry.SwathDefinition(lons=lons, lats=lats)
+    target = pr.geometry.SwathDefinition(lons=target_lons, lats=target_lats)
+    target_xyz = lonlat_to_xyz(target_lons, target_lats)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        pr_time, (expected, _, expected_counts) = best_of(lambda: resample_gauss(
+            source, values, target, radius_of_influence=params['roi'], sigmas=params['sigma'],
+            fill_value=np.nan, neighbours=neighbours, nprocs=threads, with_uncert=True))
+
+    kd_time, (result, counts) = best_of(
+        lambda: gauss_grid_kdtree(lons, lats, values, target_xyz, params, threads))
+
+    print(f'{n_points} points, {len(target_xyz)} target cells, {neighbours} neighbours, {threads} threads')
+    print(f'pyresample resample_gauss: {pr_time:.2f} s')
+    print(f'scipy cKDTree:             {kd_time:.2f} s ({pr_time / kd_time:.1f}x)')
+    print(f'max abs difference:        {np.nanmax(np.abs(result - expected)):.3e} m')
+    print(f'identical NaN mask:        {np.array_equal(np.isnan(result), np.isnan(expected))}')
+    print(f'identical counts:          {np.array_equal(counts, expected_counts)}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
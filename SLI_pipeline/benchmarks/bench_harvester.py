@@ -0,0 +1,56 @@
+"""
+Times harvesting a synthetic dataset from a local stand-in for the PODAAC drive
+with different numbers of worker threads. Each request to the stand-in waits
+latency seconds, as requests to the drive wait on its round trip.
+
+    python benchmarks/bench_harvester.py [granules_per_year] [latency] [workers ...]
+"""
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'tests'))
+import harvester  # noqa: E402
+from webdav_standin import drive_client, make_granules, serve_drive  # noqa: E402
+
+CONFIG = {'ds_name': 'ENVISAT_1', 'start': '20020101', 'end': '20041231'}
+
+
+def main(n=60, latency=0.05, *workers):
+    workers = workers or (1, 2, 4, 8)
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        granules = make_granules(tmp_dir / 'drive', 'envisat-1', 'ENVISAT-1', [2002, 2003, 2004],
+                                 n=n, size=200000)
+        server = serve_drive(tmp_dir / 'drive', latency=latency)
+        harvester.drive_connection = lambda: drive_client(server)
+
+        print(f'{len(granules)} granules in 3 years, {latency * 1000:.0f} ms per request')
+        serial = None
+        for count in workers:
+            target_dir = tmp_dir / f'workers_{count}' / 'harvested_granules'
+            harvester._THREAD_CLIENTS = threading.local()
+
+            start = time.perf_counter()
+            harvester.podaac_drive_harvester(CONFIG, target_dir, workers=count)
+            elapsed = time.perf_counter() - start
+            serial = serial or elapsed
+
+            downloaded = len(list(target_dir.glob('*/*.h5')))
+            print(f'{count} workers: {elapsed:.2f} s ({serial / elapsed:.1f}x), '
+                  f'{downloaded} of {len(granules)} granules')
+
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    n = int(args[0]) if args else 60
+    latency = float(args[1]) if len(args) > 1 else 0.05
+    main(n, latency, *[int(arg) for arg in args[2:]])
@@ -7,4 +7,52 @@ Path.mkdir(OUTPUT_DIR, parents=True, exist_ok=True)
 
 FILE_FORMAT = '.h5'
 
+# Number of granules downloaded concurrently per dataset, each thread with its own
+# pooled WebDAV session. 1 downloads serially.
+HARVEST_WORKERS = 1
+# Times a failed or incomplete granule download is retried, with exponential backoff
+HARVEST_RETRIES = 3
+# Remote year directory listings are cached. Years whose directory changed are always
+# relisted, as are this many of the latest years of datasets ending 'now'.
+LISTING_REFRESH_YEARS = 2
+
+# Number of cycles gridded concurrently. 1 grids cycles serially.
+GRIDDING_WORKERS = 1
+# Threads each gridding worker gives to resample_gauss
+GRIDDING_THREADS = 4
+# Gaussian gridding engine: 'pyresample' (resample_gauss) or 'kdtree' (scipy cKDTree)
+GRIDDING_ENGINE = 'pyresample'
+# Drop along track points beyond the radius of influence of every wet grid cell
+# before gridding. Those points can never be neighbours, so results are unchanged.
+PRUNE_TO_COVERAGE = True
+# Bin along track points into superobservations of this size (degrees) before
+# gridding, ie: 0.125. None grids every point. Superobservations are weighted by,
+# and counted as, the number of points in their bin with either engine.
+SUPEROBS_BIN_SIZE = None
+# Also grid the unbinned points and log the superobservation error
+SUPEROBS_REPORT_ERROR = False
+# Grid cycles by adding up per-day Gaussian accumulators instead of regridding
+# every day in each 10 day window
+DAILY_ACCUMULATORS = False
+# Repack each mission-year of harvested granules into one time sorted columnar
+# file (datasets/<MISSION>/consolidated/<year>.h5) and read cycles from it
+CONSOLIDATED_STORE = False
+
+# Persist the reference grid geometry as memory mapped .npy files in OUTPUT_DIR/ref_grid
+PERSIST_REF_GRID = True
+# Keep a memory mapped float32 cube of every gridded cycle's SSHA and counts in
+# OUTPUT_DIR/gridded_cycles_cube, updated as cycles are gridded: 'full' for
+# (time, latitude, longitude), 'wet' for (time, n_wet) ocean cells only, None for no cube
+CYCLE_CUBE = None
+
+# Number of cycles whose indicators are calculated concurrently. 1 calculates serially.
+INDICATOR_WORKERS = 1
+# Store each cycle's SSHA_GLOBAL_linear_trend field in globals.nc. It is derivable
+# from the BH offset and trend reference fields. Changing this only affects newly
+# calculated cycles, so remove indicator/stores to apply it to the whole record.
+STORE_LINEAR_TREND = True
+# Bytes of time slices held in memory at once while writing the combined indicator
+# products from their stores. Bounds peak memory of the globals.nc write.
+INDICATOR_MEMORY_BUDGET = 512 * 2 ** 20
+
 os.chdir(ROOT_DIR)
@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+
+import numpy as np
+import xarray as xr
+
+from ref_grid import ref_grid
+
+# Center date of the first weekly cycle. Row i of the cube holds the cycle
+# CUBE_ORIGIN + i * CUBE_STEP days.
+CUBE_ORIGIN = np.datetime64('1992-10-05')
+CUBE_STEP = 7
+
+# Rows are added a year of cycles at a time, so appending a cycle rarely copies the cube
+GROWTH_ROWS = 52
+
+FIELDS = ['SSHA', 'counts']
+
+
+def cube_dir(output_dir):
+    return output_dir / 'gridded_cycles_cube'
+
+
+def cube_row(date) -> int:
+    return int((np.datetime64(date, 'D') - CUBE_ORIGIN) // np.timedelta64(CUBE_STEP, 'D'))
+
+
+def cube_meta(layout: str) -> dict:
+    '''
+    Describes a cube's layout, so cubes built for another layout or grid are rebuilt
+    '''
+    grid = ref_grid()
+    meta = {
+        'layout': layout,
+        'origin': str(CUBE_ORIGIN),
+        'step_days': CUBE_STEP,
+        'shape': [len(grid['lat']), len(grid['lon'])] if layout == 'full' else [len(grid['wet'])],
+        'n_wet': len(grid['wet'])
+    }
+    return meta
+
+
+def load_meta(output_dir):
+    try:
+        with open(cube_dir(output_dir) / 'meta.json') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def create_cube(output_dir, layout: str, rows: int):
+    '''
+    Creates an empty cube with room for rows cycles, replacing any existing one
+    '''
+    path = cube_dir(output_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    meta = cube_meta(layout)
+
+    for field in FIELDS:
+        values = np.lib.format.open_memmap(path / f'{field}.npy', mode='w+', dtype=np.float32,
+                                           shape=(rows,) + tuple(meta['shape']))
+        values[:] = np.nan
+        values.flush()
+        del values
+    np.save(path / 'valid.npy', np.zeros(rows, dtype=np.int8))
+    if layout == 'wet':
+        np.save(path / 'wet.npy', np.asarray(ref_grid()['wet']))
+
+    with open(path / 'meta.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def grow_cube(output_dir, rows: int):
+    '''
+    Extends every field of the cube to rows cycles, filling the new rows with NaN
+    '''
+    path = cube_dir(output_dir)
+
+    for field in FIELDS:
+        old = np.load(path / f'{field}.npy', mmap_mode='r')
+        tmp_path = path / f'{field}.tmp.npy'
+        new = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=old.dtype,
+                                        shape=(rows,) + old.shape[1:])
+        for start in range(0, len(old), GROWTH_ROWS):
+            new[start:start + GROWTH_ROWS] = old[start:start + GROWTH_ROWS]
+        new[len(old):] = np.nan
+        new.flush()
+        del old, new
+        os.replace(tmp_path, path / f'{field}.npy')
+
+    valid = np.load(path / 'valid.npy')
+    np.save(path / 'valid.npy', np.concatenate([valid, np.zeros(rows - len(valid), dtype=np.int8)]))
+
+
+def cube_dates(output_dir, layout: str) -> set:
+    """
+    The cycle dates held by the cube. A cube of another layout or grid is
+    dropped, so every cycle is written again.
+
+    Params:
+        output_dir (Path): the pipeline output directory
+        layout (str): 'full' for (time, latitude, longitude) or 'wet' for (time, n_wet)
+
+    Returns:
+        dates (set): YYYY-MM-DD dates of the cube's valid rows
+    """
+    meta = load_meta(output_dir)
+    if meta != cube_meta(layout):
+        if meta is not None:
+            logging.info(f'Rebuilding {layout} gridded cycle cube')
+        create_cube(output_dir, layout, GROWTH_ROWS)
+        return set()
+
+    valid = np.load(cube_dir(output_dir) / 'valid.npy')
+    return {str(CUBE_ORIGIN + np.timedelta64(row * CUBE_STEP, 'D')) for row in np.flatnonzero(valid)}
+
+
+def prepare_cube(output_dir, dates):
+    '''
+    Makes room for the given cycles and flags their rows invalid until they are written
+    '''
+    path = cube_dir(output_dir)
+    rows = [cube_row(date) for date in dates]
+    if not rows:
+        return
+
+    capacity = len(np.load(path / 'valid.npy', mmap_mode='r'))
+    if max(rows) >= capacity:
+        grow_cube(output_dir, (max(rows) // GROWTH_ROWS + 1) * GROWTH_ROWS)
+
+    valid = np.load(path / 'valid.npy')
+    valid[rows] = 0
+    np.save(path / 'valid.npy', valid)
+
+
+def write_cube_cycle(output_dir, date, gridded_ds):
+    """
+    Writes a gridded cycle's SSHA and counts into its rows of the cube. The cube
+    must already have room for it (see prepare_cube). Rows of different cycles
+    can be written concurrently.
+
+    Params:
+        output_dir (Path): the pipeline output directory
+        date (datetime64): the cycle center date
+        gridded_ds (Dataset): the gridded cycle
+    """
+    path = cube_dir(output_dir)
+    layout = load_meta(output_dir)['layout']
+    row = cube_row(date)
+
+    for field in FIELDS:
+        values = np.asarray(gridded_ds[field].values, dtype=np.float32)
+        if layout == 'wet':
+            values = values.ravel()[np.asarray(ref_grid()['wet'])]
+
+        cube = np.load(path / f'{field}.npy', mmap_mode='r+')
+        cube[row] = values
+        cube.flush()
+        del cube
+
+
+def backfill_cube_cycle(output_dir, date):
+    '''
+    Writes a cycle into the cube from its existing grid file
+    '''
+    filepath = output_dir / 'gridded_cycles' / f'ssha_global_half_deg_{str(date).replace("-", "")}.nc'
+    with xr.open_dataset(filepath) as gridded_ds:
+        write_cube_cycle(output_dir, date, gridded_ds)
+
+
+def mark_cube_cycles(output_dir, dates):
+    '''
+    Flags the rows of written cycles as valid
+    '''
+    path = cube_dir(output_dir)
+    valid = np.load(path / 'valid.npy')
+    valid[[cube_row(date) for date in dates]] = 1
+    np.save(path / 'valid.npy', valid)
+
+
+def load_cube(output_dir) -> dict:
+    """
+    Memory maps the gridded cycle cube for analysis. Rows are weekly cycles in
+    time order, so time series and spatial reductions are plain slices of the
+    SSHA and counts arrays. Rows whose 'valid' flag is 0 hold no cycle.
+
+    Params:
+        output_dir (Path): the pipeline output directory
+
+    Returns:
+        cube (dict): the layout, the row 'dates', read only 'SSHA', 'counts' and 'valid'
+                     arrays and, for the 'wet' layout, the flat grid indices of the columns
+    """
+    path = cube_dir(output_dir)
+    meta = load_meta(output_dir)
+    if meta is None:
+        raise FileNotFoundError(f'No gridded cycle cube in {output_dir}')
+
+    valid = np.load(path / 'valid.npy', mmap_mode='r')
+    cube = {
+        'layout': meta['layout'],
+        'dates': CUBE_ORIGIN + np.arange(len(valid)) * np.timedelta64(CUBE_STEP, 'D'),
+        'valid': valid
+    }
+    for field in FIELDS:
+        cube[field] = np.load(path / f'{field}.npy', mmap_mode='r')
+    if meta['layout'] == 'wet':
+        cube['wet'] = np.load(path / 'wet.npy', mmap_mode='r')
+    return cube
+
+
+def cube_field(cube, values) -> np.ndarray:
+    '''
+    Expands wet layout rows back to (..., latitude, longitude) fields, NaN over land
+    '''
+    if cube['layout'] == 'full':
+        return np.asarray(values)
+
+    grid = ref_grid()
+    field = np.full(np.shape(values)[:-1] + (len(grid['lat']) * len(grid['lon']),), np.nan,
+                    dtype=np.float32)
+    field[..., cube['wet']] = values
+    return field.reshape(np.shape(values)[:-1] + (len(grid['lat']), len(grid['lon'])))
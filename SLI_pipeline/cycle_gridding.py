@@ -1,10 +1,13 @@
-from glob import glob
+import hashlib
+import json
 import logging
 import os
 import warnings
-from datetime import datetime
-from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
 
+import h5py
 import numpy as np
 import xarray as xr
 from netCDF4 import default_fillvals  # pylint: disable=no-name-in-module
@@ -12,50 +15,165 @@ from netCDF4 import default_fillvals  # pylint: disable=no-name-in-module
 with warnings.catch_warnings():
     warnings.simplefilter('ignore', UserWarning)
     import pyresample as pr
-    from pyresample.kd_tree import resample_gauss
+    from pyresample.kd_tree import get_neighbour_info, resample_gauss
     from pyresample.utils import check_and_wrap
 
-from conf.global_settings import FILE_FORMAT
+from conf.global_settings import (CONSOLIDATED_STORE, CYCLE_CUBE, DAILY_ACCUMULATORS,
+                                  GRIDDING_ENGINE, GRIDDING_THREADS, GRIDDING_WORKERS, PRUNE_TO_COVERAGE,
+                                  SUPEROBS_BIN_SIZE, SUPEROBS_REPORT_ERROR)
+from cycle_cube import (backfill_cube_cycle, cube_dates, mark_cube_cycles, prepare_cube,
+                        write_cube_cycle)
+from cycle_summary import cycle_summary, load_summary, save_summary
+from gauss_kdtree import gauss_grid_kdtree, gauss_sums
+from granule_catalog import (REF_MISSION, add_pending_dates, clear_pending_dates, granules_in_window,
+                             open_catalog, pending_dates, sync_catalog)
+from granule_store import GRANULE_VARS, decoded_dtype, first_occurrences, read_h5_var, store_slices
+from ref_grid import coverage, ref_grid, within_coverage
+from superobs import bin_superobs, superobs_error
+
+# Center date of the first weekly cycle
+FIRST_CYCLE = np.datetime64('1992-10-05')
+
+GRIDDING_PARAMS = {
+    'roi': 6e5,  # 6e5
+    'sigma': 1e5,
+    'neighbours': 500  # 500 for production, 10 for development
+}
+
+TIME_ATTRS = {
+    'long_name': 'time',
+    'standard_name': 'time',
+    'units': 'seconds since 1985-01-01',
+    'calendar': 'gregorian',
+}
+
+LAT_ATTRS = {
+    'long_name': 'latitude',
+    'standard_name': 'latitude',
+    'units': 'degrees_north',
+    'comment': 'Positive latitude is North latitude, negative latitude is South latitude. FillValue pads the reference orbits to have same length'
+}
+
+LON_ATTRS = {
+    'long_name': 'longitude',
+    'standard_name': 'longitude',
+    'units': 'degrees_east',
+    'comment': 'East longitude relative to Greenwich meridian. FillValue pads the reference orbits to have same length'
+}
+
+SSHA_ATTRS = {
+    'long_name': 'sea surface height anomaly',
+    'standard_name': 'sea_surface_height_above_sea_level',
+    'units': 'm',
+    'valid_min': np.nan,
+    'valid_max': np.nan,
+    'comment': 'Sea level determined from satellite altitude - range - all altimetric corrections',
+}
+
+
+def cycle_window(date):
+    '''
+    The first and last (inclusive) days of a cycle's 10 day window
+    '''
+    cycle_start = date - np.timedelta64(5, 'D')
+    cycle_end = cycle_start + np.timedelta64(9, 'D')
+    return cycle_start, cycle_end
 
 
-def collect_data(output_dir, start, end):
-    def date_filter(f):
-        date = f.split('/')[-1].split('.')[0][-8:]
-        date = f'{date[:4]}-{date[4:6]}-{date[6:]}'
-        date = np.datetime64(date)
+def affected_cycles(dates) -> list:
+    """
+    The weekly cycles whose windows hold any of the given granule dates. A granule
+    dated g is in the window of cycle D when D - 5 <= g <= D + 4, so each date
+    touches at most two cycles.
 
-        if date >= start and date <= end:
-            return True
-        return False
-    
-    def ref_filter(f):
-        '''
-        Removes MERGED_ALT granules
-        '''
-        if "MERGED_ALT" in f:
-            return False
-        return True
+    Params:
+        dates (Iterable[str]): YYYY-MM-DD granule dates
+
+    Returns:
+        cycles (List[datetime64]): the affected cycle center dates, in order
+    """
+    all_dates = np.arange(FIRST_CYCLE, 'now', 7, dtype='datetime64[D]')
+
+    cycles = set()
+    for date in dates:
+        date = np.datetime64(date, 'D')
+        touched = (all_dates >= date - np.timedelta64(4, 'D')) & (all_dates <= date + np.timedelta64(5, 'D'))
+        cycles.update(all_dates[touched])
+    return sorted(cycles)
+
+
+def settled_dates(dates, checked) -> list:
+    '''
+    The granule dates whose cycles were all checked without error. Dates whose
+    cycles are not all over yet stay pending.
+    '''
+    today = np.datetime64('now', 'D')
+    return [date for date in dates
+            if np.datetime64(date, 'D') + np.timedelta64(5, 'D') < today and
+            set(affected_cycles([date])) <= checked]
+
+
+def collect_data(catalog, start, end):
+    '''
+    Looks up the granules dated within the cycle window from the granule catalog
+    '''
+    return granules_in_window(catalog, start, end)
+
+
+def gridding_config():
+    '''
+    The settings that change gridded output
+    '''
+    return {**GRIDDING_PARAMS, 'engine': GRIDDING_ENGINE, 'superobs': SUPEROBS_BIN_SIZE,
+            'daily_accumulators': DAILY_ACCUMULATORS}
 
-    # Get reference mission granules
-    ref_granules = glob(f'{output_dir}/datasets/MERGED_ALT/harvested_granules/**/*{FILE_FORMAT}')
-    ref_granules.sort()
-    ref_granules = filter(date_filter, ref_granules)
 
-    # Get other granules
-    other_granules = glob(f'{output_dir}/datasets/**/**/**/*{FILE_FORMAT}')
-    other_granules.sort()
-    other_granules = filter(date_filter, other_granules)
-    other_granules = filter(ref_filter, other_granules)
+def cycle_entry(cycle_granules):
+    """
+    Manifest entry identifying what a cycle is gridded from: a digest of its input
+    granules' names, sizes and md5 checksums, and a digest of the gridding settings.
+    Names are relative to the mission directory so entries hold across machines.
+
+    Params:
+        cycle_granules (List[dict]): catalog entries for the cycle's granules
+
+    Returns:
+        entry (dict): the 'inputs' and 'config' digests
+    """
+    inputs = sorted(f'{g["mission"]}/{os.path.basename(g["path"])}:{g["size"]}:{g["checksum"]}'
+                    for g in cycle_granules)
+    config = json.dumps(gridding_config(), sort_keys=True)
+
+    entry = {
+        'inputs': hashlib.sha1('\n'.join(inputs).encode()).hexdigest(),
+        'config': hashlib.sha1(config.encode()).hexdigest()
+    }
+    return entry
+
+
+def manifest_path(output_dir):
+    return output_dir / 'gridded_cycles_manifest.json'
+
+
+def load_manifest(output_dir) -> dict:
+    try:
+        with open(manifest_path(output_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
-    cycle_granules = list(ref_granules) + list(other_granules)
-    cycle_granules = sorted(cycle_granules, key=lambda f: f.split('/')[-1].split('.')[0][3:])
 
-    return cycle_granules
+def save_manifest(output_dir, manifest):
+    path = manifest_path(output_dir)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
 
 
-def check_updating(output_dir, cycle_granules, date):
+def check_updating(output_dir, manifest, cycle_granules, date):
     '''
-    Compare local files
+    Checks if a cycle's input granules or gridding settings changed since it was gridded
     '''
 
     # Check if gridded cycle exists
@@ -63,155 +181,408 @@ def check_updating(output_dir, cycle_granules, date):
     if not os.path.exists(grid_path):
         return True
 
-    grid_mod_time = datetime.fromtimestamp(os.path.getmtime(grid_path))
-    # Check if individual granules have been updated
-    for granule in cycle_granules:
-        mod_time = datetime.fromtimestamp(os.path.getmtime(granule))
-
-        if mod_time > grid_mod_time:
+    entry = manifest.get(str(date))
+    if entry is None:
+        # Cycles gridded before the manifest existed are compared by mtime once,
+        # then adopted into the manifest
+        grid_mod_time = os.path.getmtime(grid_path)
+        if any(granule['mtime'] > grid_mod_time for granule in cycle_granules):
             return True
+        manifest[str(date)] = cycle_entry(cycle_granules)
+        return False
 
-    return False
+    return entry != cycle_entry(cycle_granules)
 
 
 def merge_granules(cycle_granules):
-    granules = []
+    """
+    Merges granules into a single time sorted along track Dataset. Each granule's
+    ssh, lats, lons and time are read into contiguous buffers sized from the granule
+    shapes. Repeated times within a granule keep their first occurrence. With
+    CONSOLIDATED_STORE, days that are current in a mission-year store are read from
+    it as one slice instead.
 
-    for granule in cycle_granules:
-        ds = xr.open_dataset(granule, group='data')
-        ds = xr.Dataset(
-            data_vars=dict(
-                SSHA=(['time'], ds.ssh.values),
-                latitude=(['time'], ds.lats.values),
-                longitude=(['time'], ds.lons.values),
-                time=(['time'], ds.time.values)
-            )
-        )
-
-        ds.time.attrs = {
-            'long_name': 'time',
-            'standard_name': 'time',
-            'units': 'seconds since 1985-01-01',
-            'calendar': 'gregorian',
-        }
-
-        ds.latitude.attrs = {
-            'long_name': 'latitude',
-            'standard_name': 'latitude',
-            'units': 'degrees_north',
-            'comment': 'Positive latitude is North latitude, negative latitude is South latitude. FillValue pads the reference orbits to have same length'
-        }
-
-        ds.longitude.attrs = {
-            'long_name': 'longitude',
-            'standard_name': 'longitude',
-            'units': 'degrees_east',
-            'comment': 'East longitude relative to Greenwich meridian. FillValue pads the reference orbits to have same length'
-        }
-
-        ds.SSHA.attrs = {
-            'long_name': 'sea surface height anomaly',
-            'standard_name': 'sea_surface_height_above_sea_level',
-            'units': 'm',
-            'valid_min': np.nanmin(ds.SSHA.values),
-            'valid_max': np.nanmax(ds.SSHA.values),
-            'comment': 'Sea level determined from satellite altitude - range - all altimetric corrections',
-        }
-
-        # Check for duplicate time values. Drop if they are true duplicates
-        all_times = ds.time.values
-        seen = set()
-        seen_add = seen.add
-        seen_twice = list(x for x in all_times if x in seen or seen_add(x))
-        if seen_twice:
-            _, index = np.unique(ds['time'], return_index=True)
-            ds = ds.isel(time=index)
-
-        granules.append(ds)
-
-    cycle_ds = xr.concat((granules), dim='time') if len(
-        granules) > 1 else granules[0]
-    cycle_ds = cycle_ds.sortby('time')
+    Params:
+        cycle_granules (List[dict]): catalog entries for the granules to merge
+
+    Returns:
+        cycle_ds (Dataset): the merged along track data
+    """
+    slices = store_slices(cycle_granules) if CONSOLIDATED_STORE else {}
+
+    with ExitStack() as stack:
+        # (variables group, selection, check duplicates) for each read
+        sources = []
+        read_slices = set()
+        for granule in cycle_granules:
+            if granule['path'] in slices:
+                # Days sharing a store are read once as a single slice
+                store, start, end = slices[granule['path']]
+                if (store, start, end) not in read_slices:
+                    read_slices.add((store, start, end))
+                    group = stack.enter_context(h5py.File(store, 'r'))
+                    sources.append((group, slice(start, end), False))
+            else:
+                group = stack.enter_context(h5py.File(granule['path'], 'r'))['data']
+                sources.append((group, slice(0, group['time'].shape[0]), True))
+
+        sizes = [sel.stop - sel.start for _, sel, _ in sources]
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+
+        buffers = {}
+        for var in GRANULE_VARS:
+            dtype = np.result_type(*[decoded_dtype(group[var]) for group, _, _ in sources])
+            buffers[var] = np.empty(offsets[-1], dtype=dtype)
+
+        keep = np.ones(offsets[-1], dtype=bool)
+
+        for (group, sel, raw), start, end in zip(sources, offsets[:-1], offsets[1:]):
+            if not raw:
+                for var in GRANULE_VARS:
+                    group[var].read_direct(buffers[var], source_sel=sel, dest_sel=np.s_[start:end])
+                continue
+
+            for var in GRANULE_VARS:
+                read_h5_var(group[var], buffers[var][start:end])
+
+            # Check for duplicate time values. Drop if they are true duplicates
+            keep[start:end] = first_occurrences(buffers['time'][start:end])
+
+    order = np.flatnonzero(keep)
+    order = order[np.argsort(buffers['time'][order], kind='stable')]
+    data_vars = {name: (['time'], buffers[var][order])
+                 for var, name in GRANULE_VARS.items() if name != 'time'}
+    cycle_ds = xr.Dataset(data_vars=data_vars,
+                          coords={'time': (['time'], buffers['time'][order])})
+
+    cycle_ds.time.attrs = TIME_ATTRS
+    cycle_ds.latitude.attrs = LAT_ATTRS
+    cycle_ds.longitude.attrs = LON_ATTRS
+    cycle_ds.SSHA.attrs = {**SSHA_ATTRS,
+                           'valid_min': np.nanmin(cycle_ds.SSHA.values),
+                           'valid_max': np.nanmax(cycle_ds.SSHA.values)}
 
     return cycle_ds
 
 
 def gauss_grid(ssha_nn_obj, global_obj, params):
 
+    if GRIDDING_ENGINE == 'kdtree':
+        new_vals, counts = gauss_grid_kdtree(ssha_nn_obj['lon'].ravel(), ssha_nn_obj['lat'].ravel(),
+                                             ssha_nn_obj['ssha'], global_obj['wet_xyz'], params,
+                                             params['nprocs'], ssha_nn_obj.get('counts'))
+    elif 'counts' in ssha_nn_obj:
+        # resample_gauss can't weight superobservations by their point counts
+        num, den, counts = gauss_accumulate(ssha_nn_obj, global_obj, params)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            new_vals = np.where(den > 0, num / den, np.nan)
+    else:
+        tmp_ssha_lons, tmp_ssha_lats = check_and_wrap(ssha_nn_obj['lon'].ravel(),
+                                                      ssha_nn_obj['lat'].ravel())
+
+        ssha_grid = pr.geometry.SwathDefinition(
+            lons=tmp_ssha_lons, lats=tmp_ssha_lats)
+        new_vals, _, counts = resample_gauss(ssha_grid, ssha_nn_obj['ssha'],
+                                             global_obj['swath'],
+                                             radius_of_influence=params['roi'],
+                                             sigmas=params['sigma'],
+                                             fill_value=np.NaN, neighbours=params['neighbours'],
+                                             nprocs=params['nprocs'], with_uncert=True)
+
+    new_vals_2d = np.full(global_obj['area'].shape, np.nan, dtype=global_obj['area'].dtype)
+    new_vals_2d.ravel()[global_obj['wet']] = new_vals
+
+    counts_2d = np.full(global_obj['area'].shape, np.nan, dtype=global_obj['area'].dtype)
+    counts_2d.ravel()[global_obj['wet']] = counts
+    return new_vals_2d, counts_2d
+
+
+def gauss_accumulate(ssha_nn_obj, global_obj, params):
+    """
+    Splits the Gaussian weighted mean sum(w*x)/sum(w) into its numerator and
+    denominator on the wet target cells, along with the neighbour count. Accumulators
+    from separate days can be added together to grid any window of days.
+
+    Superobservations (with 'counts' in ssha_nn_obj) are weighted by, and counted
+    as, the number of along track points behind them, as in gauss_kdtree.gauss_sums.
+
+    Params:
+        ssha_nn_obj (dict): along track lat, lon and non-NaN ssha values
+        global_obj (dict): the target grid
+        params (dict): the gridding parameters
+
+    Returns:
+        num (ndarray): sum of weighted ssha for each wet cell
+        den (ndarray): sum of weights for each wet cell
+        counts (ndarray): number of neighbours (or their summed point counts) for each wet cell
+    """
+    if GRIDDING_ENGINE == 'kdtree':
+        return gauss_sums(ssha_nn_obj['lon'].ravel(), ssha_nn_obj['lat'].ravel(),
+                          ssha_nn_obj['ssha'], global_obj['wet_xyz'], params, params['nprocs'],
+                          ssha_nn_obj.get('counts'))
+
+    n_wet = len(global_obj['wet'])
+    num = np.zeros(n_wet)
+    den = np.zeros(n_wet)
+    counts = np.zeros(n_wet)
+
+    if not len(ssha_nn_obj['ssha']):
+        return num, den, counts
+
     tmp_ssha_lons, tmp_ssha_lats = check_and_wrap(ssha_nn_obj['lon'].ravel(),
                                                   ssha_nn_obj['lat'].ravel())
 
     ssha_grid = pr.geometry.SwathDefinition(
         lons=tmp_ssha_lons, lats=tmp_ssha_lats)
-    new_vals, _, counts = resample_gauss(ssha_grid, ssha_nn_obj['ssha'],
-                                         global_obj['swath'],
-                                         radius_of_influence=params['roi'],
-                                         sigmas=params['sigma'],
-                                         fill_value=np.NaN, neighbours=params['neighbours'],
-                                         nprocs=4, with_uncert=True)
-
-    new_vals_2d = np.zeros_like(global_obj['ds'].area.values) * np.nan
-    for i, val in enumerate(new_vals):
-        new_vals_2d.ravel()[global_obj['wet'][i]] = val
-
-    counts_2d = np.zeros_like(global_obj['ds'].area.values) * np.nan
-    for i, val in enumerate(counts):
-        counts_2d.ravel()[global_obj['wet'][i]] = val
-    return new_vals_2d, counts_2d
+    valid_in, valid_out, index_array, distance_array = get_neighbour_info(
+        ssha_grid, global_obj['swath'], params['roi'],
+        neighbours=params['neighbours'], nprocs=params['nprocs'])
+
+    data = ssha_nn_obj['ssha'][valid_in]
+    if index_array.ndim == 1:
+        index_array = index_array[:, np.newaxis]
+        distance_array = distance_array[:, np.newaxis]
+
+    found = index_array < len(data)
+    safe_indices = np.where(found, index_array, 0)
+    weights = np.where(found, np.exp(-distance_array ** 2 / params['sigma'] ** 2), 0)
+    vals = data[safe_indices]
+
+    if 'counts' in ssha_nn_obj:
+        obs_counts = ssha_nn_obj['counts'][valid_in][safe_indices]
+        weights *= obs_counts
+        counts[valid_out] = np.sum(found * obs_counts, axis=1)
+    else:
+        counts[valid_out] = np.sum(found, axis=1)
 
+    num[valid_out] = np.sum(weights * vals, axis=1)
+    den[valid_out] = np.sum(weights, axis=1)
 
-def gridding(cycle_ds, date, sources):
+    return num, den, counts
 
-    ref_path = Path().resolve().parent / 'ref_files'
 
-    # Prepare global map
-    global_path = ref_path / 'GRID_GEOMETRY_ECCO_V4r4_latlon_0p50deg.nc'
-    global_ds = xr.open_dataset(global_path)
+def accumulator_params():
+    return {**GRIDDING_PARAMS, 'engine': GRIDDING_ENGINE, 'superobs': SUPEROBS_BIN_SIZE,
+            'pruned': PRUNE_TO_COVERAGE}
 
-    wet_ins = np.where(global_ds.maskC.isel(Z=0).values.ravel() > 0)[0]
 
-    global_lon = global_ds.longitude.values
-    global_lat = global_ds.latitude.values
+def accumulator_path(output_dir, day):
+    return output_dir / 'daily_accumulators' / f'accum_{str(day).replace("-", "")}.npz'
 
-    global_lon_m, global_lat_m = np.meshgrid(global_lon, global_lat)
-    target_lons_wet = global_lon_m.ravel()[wet_ins]
-    target_lats_wet = global_lat_m.ravel()[wet_ins]
 
-    global_swath_def = pr.geometry.SwathDefinition(lons=target_lons_wet,
-                                                   lats=target_lats_wet)
+def granules_by_day(cycle_granules) -> dict:
+    '''
+    Groups granules by day, each day's granules ordered as they are accumulated
+    '''
+    days = defaultdict(dict)
+    for granule in cycle_granules:
+        days[granule['date']][granule['path']] = granule
 
-    global_obj = {
-        'swath': global_swath_def,
-        'ds': global_ds,
-        'wet': wet_ins
-    }
+    return {day: sorted(granules.values(), key=lambda g: (g['mission'] != REF_MISSION, g['path']))
+            for day, granules in sorted(days.items())}
+
+
+def check_accumulator(output_dir, day, day_granules):
+    '''
+    Checks if a day's accumulator is missing or its granules or settings changed
+    '''
+    path = accumulator_path(output_dir, day)
+    if not path.exists():
+        return True
+
+    with np.load(path) as accum:
+        if list(accum['granules']) != [g['path'] for g in day_granules]:
+            return True
+        if list(accum['checksums']) != [g['checksum'] for g in day_granules]:
+            return True
+        return json.loads(str(accum['params'])) != accumulator_params()
+
+
+def daily_accumulator(output_dir, day, day_granules, nprocs=GRIDDING_THREADS):
+    """
+    Computes and saves the Gaussian accumulators for a single day of along track data.
+
+    Params:
+        output_dir (Path): the pipeline output directory
+        day (str): the YYYY-MM-DD date
+        day_granules (List[dict]): catalog entries for the day's granules
+        nprocs (int): number of threads given to pyresample
+    """
+    logging.debug(f'\tAccumulating {day}')
+    day_ds = merge_granules(day_granules)
+    ssha_nn_obj = prepare_points(along_track_points(day_ds), day)
+
+    params = {**GRIDDING_PARAMS, 'nprocs': nprocs}
+    num, den, counts = gauss_accumulate(ssha_nn_obj, ref_grid(), params)
+
+    path = accumulator_path(output_dir, day)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write then rename so a reader never sees a partial accumulator
+    tmp_path = path.with_name(f'{path.stem}.tmp.npz')
+    np.savez(tmp_path, num=num, den=den, counts=counts,
+             granules=np.array([g['path'] for g in day_granules]),
+             checksums=np.array([g['checksum'] for g in day_granules]),
+             missions=np.array(sorted(set(g['mission'] for g in day_granules))),
+             params=np.array(json.dumps(accumulator_params())))
+    os.replace(tmp_path, path)
+
+
+def accumulated_gridding(output_dir, date, cycle_granules):
+    """
+    Grids a cycle by adding up the daily accumulators covering its window.
+    Neighbours are capped per day rather than per window, so cells with dense
+    coverage can draw on more than params['neighbours'] values. Their counts are
+    capped at params['neighbours'] so they mean the same as in a directly gridded
+    cycle, where validate_counts compares them against the full neighbour count.
+
+    Params:
+        output_dir (Path): the pipeline output directory
+        date (datetime64): the cycle center date
+        cycle_granules (List[dict]): catalog entries for the cycle's granules
 
+    Returns:
+        gridded_ds (Dataset): the gridded cycle
+
+    Raises:
+        ValueError: if a day's accumulator is missing or out of date, ie: its update failed
+    """
+    global_obj = ref_grid()
+
+    n_wet = len(global_obj['wet'])
+    num = np.zeros(n_wet)
+    den = np.zeros(n_wet)
+    counts = np.zeros(n_wet)
+    sources = set()
+
+    for day, day_granules in granules_by_day(cycle_granules).items():
+        if check_accumulator(output_dir, day, day_granules):
+            raise ValueError(f'{day} accumulator is missing or out of date.')
+
+        with np.load(accumulator_path(output_dir, day)) as accum:
+            num += accum['num']
+            den += accum['den']
+            counts += accum['counts']
+            sources.update(accum['missions'])
+
+    if not np.any(den > 0):
+        raise ValueError('No ssha values.')
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wet_vals = np.where(den > 0, num / den, np.nan)
+
+    new_vals = np.full(global_obj['area'].shape, np.nan)
+    new_vals.ravel()[global_obj['wet']] = wet_vals
+
+    counts_2d = np.full(global_obj['area'].shape, np.nan)
+    counts_2d.ravel()[global_obj['wet']] = np.minimum(counts, GRIDDING_PARAMS['neighbours'])
+
+    method = f'Gridded from daily Gaussian accumulators with roi={GRIDDING_PARAMS["roi"]}, ' \
+        f'sigma={GRIDDING_PARAMS["sigma"]}, daily neighbours={GRIDDING_PARAMS["neighbours"]}'
+    counts_source = f'Sum of daily neighbour counts, capped at {GRIDDING_PARAMS["neighbours"]}.'
+
+    return grid_dataset(new_vals, counts_2d, date, sorted(sources), global_obj, SSHA_ATTRS,
+                        LAT_ATTRS, LON_ATTRS, method, counts_source)
+
+
+def along_track_points(cycle_ds):
+    '''
+    Drops NaN SSHA values from the merged along track data. With PRUNE_TO_COVERAGE,
+    points further than roi from every wet target cell are dropped in the same pass.
+    '''
     # Define the 'swath' as the lats/lon pairs of the model grid
     ssha_lon = cycle_ds.longitude.values.ravel()
     ssha_lat = cycle_ds.latitude.values.ravel()
     ssha = cycle_ds.SSHA.values.ravel()
+    ssha_time = cycle_ds.time.values.ravel()
 
-    ssha_lat_nn = ssha_lat[~np.isnan(ssha)]
-    ssha_lon_nn = ssha_lon[~np.isnan(ssha)]
-    ssha_nn = ssha[~np.isnan(ssha)]
+    keep = ~np.isnan(ssha)
+    if PRUNE_TO_COVERAGE:
+        keep &= within_coverage(ssha_lon, ssha_lat, coverage(GRIDDING_PARAMS['roi']))
 
     ssha_nn_obj = {
-        'lat': ssha_lat_nn,
-        'lon': ssha_lon_nn,
-        'ssha': ssha_nn
+        'lat': ssha_lat[keep],
+        'lon': ssha_lon[keep],
+        'ssha': ssha[keep],
+        'time': ssha_time[keep]
     }
+    return ssha_nn_obj
+
+
+def prepare_points(ssha_nn_obj, label):
+    '''
+    Collapses the along track points into superobservations when SUPEROBS_BIN_SIZE is set
+    '''
+    if not SUPEROBS_BIN_SIZE or not len(ssha_nn_obj['ssha']):
+        return ssha_nn_obj
+
+    superobs_obj = bin_superobs(ssha_nn_obj, SUPEROBS_BIN_SIZE)
+    n_points = len(ssha_nn_obj['ssha'])
+    n_bins = len(superobs_obj['ssha'])
+    logging.info(f'{label} superobservations: {n_points} points binned to {n_bins} '
+                 f'({n_points / n_bins:.1f}x reduction)')
+    return superobs_obj
 
-    params = {
-        'roi': 6e5,  # 6e5
-        'sigma': 1e5,
-        'neighbours': 500  # 500 for production, 10 for development
-    }
 
-    if np.sum(~np.isnan(ssha_nn)) > 0:
-        new_vals, counts = gauss_grid(ssha_nn_obj, global_obj, params)
+def gridding(cycle_ds, date, sources, nprocs=GRIDDING_THREADS):
+
+    global_obj = ref_grid()
+
+    ssha_nn_obj = along_track_points(cycle_ds)
+    points_obj = prepare_points(ssha_nn_obj, date)
+
+    params = {**GRIDDING_PARAMS, 'nprocs': nprocs}
+
+    if np.sum(~np.isnan(ssha_nn_obj['ssha'])) > 0:
+        new_vals, counts = gauss_grid(points_obj, global_obj, params)
     else:
         raise ValueError('No ssha values.')
 
+    if SUPEROBS_BIN_SIZE and SUPEROBS_REPORT_ERROR:
+        full_vals, _ = gauss_grid(ssha_nn_obj, global_obj, params)
+        rms, max_diff = superobs_error(new_vals, full_vals)
+        logging.info(f'{date} superobservation error vs unbinned grid: '
+                     f'RMS {rms:.3e} m, max {max_diff:.3e} m')
+
+    if GRIDDING_ENGINE == 'kdtree':
+        method = f'Gridded using scipy cKDTree Gaussian weighting with roi={params["roi"]}, ' \
+            f'sigma={params["sigma"]}, neighbours={params["neighbours"]}'
+        counts_source = 'Number of neighbours returned from the cKDTree query.'
+    else:
+        method = f'Gridded using pyresample resample_gauss with roi={params["roi"]}, \
+            neighbours={params["neighbours"]}'
+        counts_source = 'Returned from pyresample resample_gauss function.'
+
+    if SUPEROBS_BIN_SIZE:
+        method += f', from {SUPEROBS_BIN_SIZE} degree superobservations weighted by their point counts'
+        counts_source = 'Number of along track points behind the neighbouring superobservations.'
+
+    return grid_dataset(new_vals, counts, date, sources, global_obj, cycle_ds['SSHA'].attrs,
+                        cycle_ds['latitude'].attrs, cycle_ds['longitude'].attrs,
+                        method, counts_source)
+
+
+def grid_dataset(new_vals, counts, date, sources, global_obj, ssha_attrs, lat_attrs,
+                 lon_attrs, method, counts_source):
+    """
+    Packages gridded SSHA values and counts into the gridded cycle Dataset.
+
+    Params:
+        new_vals (ndarray): 2D gridded SSHA values
+        counts (ndarray): 2D number of values used for each grid cell
+        date (datetime64): the cycle center date
+        sources (List[str]): the datasets contributing to the cycle
+        global_obj (dict): the target grid
+        ssha_attrs, lat_attrs, lon_attrs (dict): along track variable attributes
+        method (str): the gridding_method attribute
+        counts_source (str): the counts source attribute
+
+    Returns:
+        gridded_ds (Dataset): the gridded cycle
+    """
+    global_lon = np.asarray(global_obj['lon'])
+    global_lat = np.asarray(global_obj['lat'])
+
     time_seconds = date.astype('datetime64[s]').astype('int')
 
     gridded_da = xr.DataArray(new_vals, dims=['latitude', 'longitude'],
@@ -231,12 +602,12 @@ def gridding(cycle_ds, date, sources):
     gridded_ds['counts'] = counts_da
 
     gridded_ds['mask'] = (['latitude', 'longitude'], np.where(
-        global_ds['maskC'].isel(Z=0) == True, 1, 0))
+        global_obj['mask'], 1, 0))
 
     gridded_ds['mask'].attrs = {'long_name': 'wet/dry boolean mask for grid cell',
                                 'comment': '1 for ocean, otherwise 0'}
 
-    gridded_ds['SSHA'].attrs = cycle_ds['SSHA'].attrs
+    gridded_ds['SSHA'].attrs = ssha_attrs
     gridded_ds['SSHA'].attrs['valid_min'] = np.nanmin(
         gridded_ds['SSHA'].values)
     gridded_ds['SSHA'].attrs['valid_max'] = np.nanmax(
@@ -247,11 +618,11 @@ def gridding(cycle_ds, date, sources):
         'valid_min': np.nanmin(counts_da.values),
         'valid_max': np.nanmax(counts_da.values),
         'long_name': 'number of data values used in weighting each element in SSHA',
-        'source': 'Returned from pyresample resample_gauss function.'
+        'source': counts_source
     }
 
-    gridded_ds['latitude'].attrs = cycle_ds['latitude'].attrs
-    gridded_ds['longitude'].attrs = cycle_ds['longitude'].attrs
+    gridded_ds['latitude'].attrs = lat_attrs
+    gridded_ds['longitude'].attrs = lon_attrs
 
     gridded_ds['time'].attrs = {
         'long_name': 'time',
@@ -261,9 +632,7 @@ def gridding(cycle_ds, date, sources):
         'comment': 'seconds since 1970-01-01 00:00:00'
     }
 
-    gridded_ds.attrs['gridding_method'] = \
-        f'Gridded using pyresample resample_gauss with roi={params["roi"]}, \
-            neighbours={params["neighbours"]}'
+    gridded_ds.attrs['gridding_method'] = method
 
     gridded_ds.attrs['source'] = 'Combination of ' + \
         ', '.join(sources) + ' along track instruments'
@@ -307,47 +676,219 @@ def cycle_ds_encoding(cycle_ds):
     return encoding
 
 
-def cycle_gridding(output_dir):
-    ALL_DATES = np.arange('1992-10-05', 'now', 7, dtype='datetime64[D]')
+def process_cycle(output_dir, date, cycle_granules, nprocs=GRIDDING_THREADS):
+    """
+    Merges, grids and saves a single cycle.
+
+    Params:
+        output_dir (Path): the pipeline output directory
+        date (datetime64): the cycle center date
+        cycle_granules (List[dict]): catalog entries for the cycle's granules
+        nprocs (int): number of threads given to resample_gauss
+
+    Returns:
+        summary (dict): the cycle's summary statistics from cycle_summary
+
+    Raises:
+        ValueError: if the cycle window has no ssha values
+    """
+    logging.info(f'Processing {date} cycle')
+    sources = sorted(set([g['mission'] for g in cycle_granules]))
+
+    if DAILY_ACCUMULATORS:
+        logging.debug(f'\tGridding {date} cycle from daily accumulators...')
+        gridded_ds = accumulated_gridding(output_dir, date, cycle_granules)
+    else:
+        logging.debug(f'\tMerging granules for {date} cycle')
+        cycle_ds = merge_granules(cycle_granules)
+
+        logging.debug(f'\tGridding {date} cycle...')
+        gridded_ds = gridding(cycle_ds, date, sources, nprocs)
+    logging.debug(f'\tGridding {date} cycle complete.')
+
+    # Save the gridded cycle
+    encoding = cycle_ds_encoding(gridded_ds)
+
+    grid_dir = output_dir / 'gridded_cycles'
+    grid_dir.mkdir(parents=True, exist_ok=True)
+    filename = f'ssha_global_half_deg_{str(date).replace("-", "")}.nc'
+    filepath = grid_dir / filename
+
+    gridded_ds.to_netcdf(filepath, encoding=encoding)
+
+    if CYCLE_CUBE:
+        write_cube_cycle(output_dir, date, gridded_ds)
+
+    return cycle_summary(date, gridded_ds, filepath, sources,
+                         cycle_entry(cycle_granules)['inputs'])
+
+
+def backfill_summary(output_dir, date, cycle_granules):
+    '''
+    Summarizes a cycle gridded before summaries were recorded
+    '''
+    filepath = output_dir / 'gridded_cycles' / f'ssha_global_half_deg_{str(date).replace("-", "")}.nc'
+    with xr.open_dataset(filepath) as gridded_ds:
+        return cycle_summary(date, gridded_ds, filepath,
+                             sorted(set([g['mission'] for g in cycle_granules])),
+                             cycle_entry(cycle_granules)['inputs'])
+
+
+def update_daily_accumulators(output_dir, pending, workers=GRIDDING_WORKERS,
+                              threads=GRIDDING_THREADS):
+    """
+    Computes the missing or stale daily accumulators for the days covered by the
+    pending cycles. Each day is accumulated once even though it is shared by
+    overlapping cycle windows. A day that fails keeps its stale accumulator, which
+    accumulated_gridding refuses to use, so its cycles fail rather than being
+    gridded from outdated data.
+
+    Params:
+        output_dir (Path): the pipeline output directory
+        pending (List[tuple]): (date, cycle_granules) for each cycle needing gridding
+        workers (int): number of days accumulated at once
+        threads (int): number of threads each worker gives to pyresample
+    """
+    days = granules_by_day([granule for _, cycle_granules in pending for granule in cycle_granules])
+
+    stale = [(day, day_granules) for day, day_granules in days.items()
+             if check_accumulator(output_dir, day, day_granules)]
+
+    logging.info(f'Updating {len(stale)} daily accumulators')
+
+    if workers > 1 and len(stale) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(daily_accumulator, output_dir, day, day_granules, threads): day
+                       for day, day_granules in stale}
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.exception(f'\nError while accumulating {futures[future]}. {e}')
+    else:
+        for day, day_granules in stale:
+            try:
+                daily_accumulator(output_dir, day, day_granules, threads)
+            except Exception as e:
+                logging.exception(f'\nError while accumulating {day}. {e}')
+
+
+def cycle_gridding(output_dir, workers=GRIDDING_WORKERS, threads=GRIDDING_THREADS, dates=None):
+    """
+    Grids every weekly cycle whose input granules or gridding settings have changed
+    since it was last gridded, as recorded in the gridded cycles manifest. Given
+    dates, only those cycles are checked (see affected_cycles). Granule dates
+    pending in the catalog are cleared once their cycles are checked, and failed
+    cycles are left pending for the next run. Summary
+    statistics of each gridded cycle are recorded in the gridded cycles summary, and
+    with CYCLE_CUBE set its values are kept in the gridded cycle cube.
+    With more than one worker, cycles are gridded concurrently in a process pool. Each
+    cycle is still gridded by process_cycle, so output files match the serial path.
+
+    Params:
+        output_dir (Path): the pipeline output directory
+        workers (int): number of cycles gridded at once
+        threads (int): number of threads each worker gives to resample_gauss
+        dates (List[datetime64]): the cycles to check. Defaults to every cycle.
+    """
+    ALL_DATES = np.arange(FIRST_CYCLE, 'now', 7, dtype='datetime64[D]')
+    if dates is not None:
+        ALL_DATES = np.array(dates, dtype='datetime64[D]')
 
     failed_grids = []
 
-    # The main loop
+    # Pick up granules added, changed or removed outside the harvester
+    catalog = open_catalog(output_dir)
+    sync_catalog(catalog, output_dir)
+    manifest = load_manifest(output_dir)
+    summary = load_summary(output_dir)
+    in_cube = cube_dates(output_dir, CYCLE_CUBE) if CYCLE_CUBE else None
+
+    # Cycles already gridded but missing from the cube
+    cube_backfill = []
+
+    # Find the cycles needing (re)gridding
+    pending = []
     for date in ALL_DATES:
-        cycle_start = date - np.timedelta64(5, 'D')
-        cycle_end = cycle_start + np.timedelta64(9, 'D')
+        cycle_start, cycle_end = cycle_window(date)
 
         try:
-            cycle_granules = collect_data(output_dir, cycle_start, cycle_end)
+            cycle_granules = collect_data(catalog, cycle_start, cycle_end)
 
-            if not cycle_granules or not check_updating(output_dir, cycle_granules, date):
+            if not cycle_granules or not check_updating(output_dir, manifest, cycle_granules, date):
                 logging.info(f'No update needed for {date} cycle')
+                if cycle_granules and str(date) not in summary:
+                    summary[str(date)] = backfill_summary(output_dir, date, cycle_granules)
+                if cycle_granules and CYCLE_CUBE and str(date) not in in_cube:
+                    cube_backfill.append(date)
                 continue
 
-            logging.info(f'Processing {date} cycle')
-            logging.debug(f'\tMerging granules for {date} cycle')
-            cycle_ds = merge_granules(cycle_granules)
-            sources = list(set([g.split('/datasets/')[1].split('/')[0] for g in cycle_granules]))
+            pending.append((date, cycle_granules))
 
-            logging.debug(f'\tGridding {date} cycle...')
-            gridded_ds = gridding(cycle_ds, date, sources)
-            logging.debug(f'\tGridding {date} cycle complete.')
+        except Exception as e:
+            failed_grids.append(date)
+            logging.exception(f'\nError while processing cycle {date}. {e}')
 
-            # Save the gridded cycle
-            encoding = cycle_ds_encoding(gridded_ds)
+    catalog.close()
 
-            grid_dir = output_dir / 'gridded_cycles'
-            grid_dir.mkdir(parents=True, exist_ok=True)
-            filename = f'ssha_global_half_deg_{str(date).replace("-", "")}.nc'
-            filepath = grid_dir / filename
+    # Build the reference grid once so forked workers inherit it
+    if pending:
+        ref_grid()
+        if PRUNE_TO_COVERAGE:
+            coverage(GRIDDING_PARAMS['roi'])
 
-            gridded_ds.to_netcdf(filepath, encoding=encoding)
+    if CYCLE_CUBE:
+        prepare_cube(output_dir, cube_backfill + [date for date, _ in pending])
+        if cube_backfill:
+            logging.info(f'Adding {len(cube_backfill)} gridded cycles to the cube')
+            for date in cube_backfill:
+                backfill_cube_cycle(output_dir, date)
+            mark_cube_cycles(output_dir, cube_backfill)
 
-        except Exception as e:
-            failed_grids.append(date)
-            logging.exception(f'\nError while processing cycle {date}. {e}')
+    if DAILY_ACCUMULATORS:
+        update_daily_accumulators(output_dir, pending, workers, threads)
+
+    entries = {date: cycle_entry(cycle_granules) for date, cycle_granules in pending}
+
+    # The main loop
+    try:
+        if workers > 1 and len(pending) > 1:
+            logging.info(f'Gridding {len(pending)} cycles with {workers} workers')
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(process_cycle, output_dir, date, cycle_granules, threads): date
+                           for date, cycle_granules in pending}
+
+                for future in as_completed(futures):
+                    date = futures[future]
+                    try:
+                        summary[str(date)] = future.result()
+                        manifest[str(date)] = entries[date]
+                    except Exception as e:
+                        failed_grids.append(date)
+                        logging.exception(f'\nError while processing cycle {date}. {e}')
+        else:
+            for date, cycle_granules in pending:
+                try:
+                    summary[str(date)] = process_cycle(output_dir, date, cycle_granules, threads)
+                    manifest[str(date)] = entries[date]
+                except Exception as e:
+                    failed_grids.append(date)
+                    logging.exception(f'\nError while processing cycle {date}. {e}')
+    finally:
+        save_manifest(output_dir, manifest)
+        save_summary(output_dir, summary)
+        if CYCLE_CUBE:
+            mark_cube_cycles(output_dir, [date for date, _ in pending if date not in failed_grids])
 
     if failed_grids:
         logging.info(f'{len(failed_grids)} grids failed. Check logs')
 
+    # A failed cycle stays pending through its center date, the only date touching just it
+    catalog = open_catalog(output_dir)
+    add_pending_dates(catalog, failed_grids)
+    checked = set(ALL_DATES) - set(failed_grids)
+    clear_pending_dates(catalog, settled_dates(pending_dates(catalog), checked))
+    catalog.close()
+
     return
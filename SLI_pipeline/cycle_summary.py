@@ -0,0 +1,62 @@
+import json
+import os
+
+import numpy as np
+
+from granule_catalog import file_md5
+
+# Latitude band the mean counts are taken over, matching the indicators' validation
+COUNTS_BAND = 66
+
+
+def summary_path(output_dir):
+    return output_dir / 'gridded_cycles_summary.json'
+
+
+def load_summary(output_dir) -> dict:
+    try:
+        with open(summary_path(output_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_summary(output_dir, summary):
+    path = summary_path(output_dir)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(summary, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def cycle_summary(date, gridded_ds, grid_path, sources, inputs) -> dict:
+    """
+    Compact statistics of a saved gridded cycle, so later stages can filter and
+    validate cycles without opening their grid files.
+
+    Params:
+        date (datetime64): the cycle center date
+        gridded_ds (Dataset): the gridded cycle
+        grid_path (Path): the saved grid file
+        sources (List[str]): the datasets contributing to the cycle
+        inputs (str): the digest of the cycle's input granules
+
+    Returns:
+        summary (dict): date, n_points (grid cells with SSHA values), band_mean_counts
+                        (mean counts within COUNTS_BAND degrees of the equator),
+                        valid_min, valid_max, sources, inputs and checksum (md5 of the grid file)
+    """
+    ssha = gridded_ds['SSHA'].values
+    band_counts = gridded_ds['counts'].sel(latitude=slice(-COUNTS_BAND, COUNTS_BAND)).values
+
+    summary = {
+        'date': str(date),
+        'n_points': int(np.sum(~np.isnan(ssha))),
+        'band_mean_counts': float(np.nanmean(band_counts)),
+        'valid_min': float(np.nanmin(ssha)),
+        'valid_max': float(np.nanmax(ssha)),
+        'sources': list(sources),
+        'inputs': inputs,
+        'checksum': file_md5(grid_path)
+    }
+    return summary
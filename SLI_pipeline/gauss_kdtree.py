@@ -0,0 +1,93 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Earth radius pyresample uses for its cartesian neighbour search
+EARTH_RADIUS = 6370997.0
+
+# Number of target cells queried at once, bounding the (chunk x neighbours) work arrays
+CHUNK_SIZE = 10000
+
+
+def lonlat_to_xyz(lons, lats) -> np.ndarray:
+    '''
+    Converts lon/lat degrees to cartesian coordinates on the sphere
+    '''
+    lons = np.deg2rad(np.asarray(lons, dtype=np.float64))
+    lats = np.deg2rad(np.asarray(lats, dtype=np.float64))
+
+    xyz = np.empty((lons.size, 3))
+    xyz[:, 0] = EARTH_RADIUS * np.cos(lats) * np.cos(lons)
+    xyz[:, 1] = EARTH_RADIUS * np.cos(lats) * np.sin(lons)
+    xyz[:, 2] = EARTH_RADIUS * np.sin(lats)
+    return xyz
+
+
+def gauss_sums(lons, lats, values, target_xyz, params, threads=1, obs_counts=None):
+    """
+    Gaussian weighted sums of the nearest along track values around each target cell.
+    Neighbours are the params['neighbours'] closest values within params['roi'] meters
+    (chord distance), weighted by exp(-d**2 / sigma**2) as in pyresample's resample_gauss.
+
+    Params:
+        lons, lats (ndarray): along track positions
+        values (ndarray): along track values
+        target_xyz (ndarray): cartesian coordinates of the target cells
+        params (dict): the gridding parameters
+        threads (int): number of threads used for the tree queries
+        obs_counts (ndarray): optional number of along track values behind each value
+                              (for superobservations). Weights and counts scale by it.
+
+    Returns:
+        num (ndarray): sum of weighted values for each target cell
+        den (ndarray): sum of weights for each target cell
+        counts (ndarray): number of neighbours (or summed obs_counts) for each target cell
+    """
+    n_targets = len(target_xyz)
+    num = np.zeros(n_targets)
+    den = np.zeros(n_targets)
+    counts = np.zeros(n_targets)
+
+    if not len(values):
+        return num, den, counts
+
+    tree = cKDTree(lonlat_to_xyz(lons, lats))
+    k = min(params['neighbours'], len(values))
+
+    for start in range(0, n_targets, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, n_targets)
+
+        distances, indices = tree.query(target_xyz[start:end], k=k,
+                                        distance_upper_bound=params['roi'],
+                                        workers=threads)
+        if k == 1:
+            distances = distances[:, np.newaxis]
+            indices = indices[:, np.newaxis]
+
+        found = indices < len(values)
+        weights = np.exp(-np.where(found, distances, 0) ** 2 / params['sigma'] ** 2)
+        weights *= found
+
+        safe_indices = np.where(found, indices, 0)
+        if obs_counts is not None:
+            weights *= obs_counts[safe_indices]
+            counts[start:end] = np.sum(found * obs_counts[safe_indices], axis=1)
+        else:
+            counts[start:end] = np.sum(found, axis=1)
+
+        num[start:end] = np.sum(weights * values[safe_indices], axis=1)
+        den[start:end] = np.sum(weights, axis=1)
+
+    return num, den, counts
+
+
+def gauss_grid_kdtree(lons, lats, values, target_xyz, params, threads=1, obs_counts=None):
+    '''
+    Gaussian weighted mean of the along track values for each target cell, NaN where
+    no values are within the radius of influence
+    '''
+    num, den, counts = gauss_sums(lons, lats, values, target_xyz, params, threads, obs_counts)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.where(den > 0, num / den, np.nan)
+
+    return result, counts
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import sqlite3
+from pathlib import Path
+
+from conf.global_settings import FILE_FORMAT
+
+REF_MISSION = 'MERGED_ALT'
+
+
+def catalog_path(output_dir: Path) -> Path:
+    return Path(output_dir) / 'datasets' / 'granule_catalog.db'
+
+
+def granule_date(path) -> str:
+    '''
+    Returns the YYYY-MM-DD date encoded at the end of a granule filename
+    '''
+    date = Path(path).name.split('.')[0][-8:]
+    return f'{date[:4]}-{date[4:6]}-{date[6:]}'
+
+
+def open_catalog(output_dir: Path) -> sqlite3.Connection:
+    """
+    Opens (and creates if necessary) the granule catalog. An empty catalog is
+    populated from the harvested granules already on disk. Besides the granules,
+    the catalog queues the dates whose changes are still to be gridded.
+
+    Params:
+        output_dir (Path): the pipeline output directory
+
+    Returns:
+        conn (Connection): sqlite connection to the catalog
+    """
+    path = catalog_path(output_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE IF NOT EXISTS granules (
+                        path TEXT PRIMARY KEY,
+                        mission TEXT NOT NULL,
+                        date TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        mtime REAL NOT NULL,
+                        checksum TEXT)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS granules_date ON granules (date)')
+    conn.execute('CREATE TABLE IF NOT EXISTS pending_dates (date TEXT PRIMARY KEY)')
+
+    # Catalogs created before checksums were tracked get them on their next sync
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(granules)')]
+    if 'checksum' not in columns:
+        conn.execute('ALTER TABLE granules ADD COLUMN checksum TEXT')
+    conn.commit()
+
+    if conn.execute('SELECT COUNT(*) FROM granules').fetchone()[0] == 0:
+        sync_catalog(conn, output_dir)
+
+    return conn
+
+
+def file_md5(path) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def sync_mission(conn: sqlite3.Connection, output_dir: Path, mission: str):
+    """
+    Brings a mission's catalog entries in line with its harvested granules directory.
+    New or modified granules are (re)registered with their md5 checksum and entries for
+    removed files are dropped. The dates of changed granules are queued in pending_dates.
+
+    Params:
+        conn (Connection): sqlite connection to the catalog
+        output_dir (Path): the pipeline output directory
+        mission (str): the dataset name, ie: MERGED_ALT
+
+    Returns:
+        changed_dates (set): YYYY-MM-DD dates of granules added, removed or whose contents changed
+    """
+    granule_dir = Path(output_dir) / 'datasets' / mission / 'harvested_granules'
+
+    known = {row['path']: (row['size'], row['mtime'], row['checksum']) for row in
+             conn.execute('SELECT path, size, mtime, checksum FROM granules WHERE mission = ? '
+                          'AND checksum IS NOT NULL', (mission,))}
+
+    changed_dates = set()
+    on_disk = set()
+    for granule in granule_dir.glob(f'*/*{FILE_FORMAT}'):
+        stat = granule.stat()
+        on_disk.add(str(granule))
+        entry = known.get(str(granule))
+        if entry is None or entry[:2] != (stat.st_size, stat.st_mtime):
+            checksum = file_md5(granule)
+            conn.execute('INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?, ?)',
+                         (str(granule), mission, granule_date(granule),
+                          stat.st_size, stat.st_mtime, checksum))
+            if entry is None or entry[2] != checksum:
+                changed_dates.add(granule_date(granule))
+
+    cataloged = [row['path'] for row in
+                 conn.execute('SELECT path FROM granules WHERE mission = ?', (mission,))]
+    removed = [path for path in cataloged if path not in on_disk]
+    conn.executemany('DELETE FROM granules WHERE path = ?', [(path,) for path in removed])
+
+    changed_dates.update(granule_date(path) for path in removed)
+    add_pending_dates(conn, changed_dates)
+    return changed_dates
+
+
+def sync_catalog(conn: sqlite3.Connection, output_dir: Path):
+    '''
+    Rescans every mission directory under datasets/
+    '''
+    datasets_dir = Path(output_dir) / 'datasets'
+    missions = [d.name for d in datasets_dir.iterdir() if d.is_dir()]
+
+    logging.info(f'Building granule catalog for {len(missions)} datasets')
+    for mission in sorted(missions):
+        sync_mission(conn, output_dir, mission)
+
+
+def pending_dates(conn: sqlite3.Connection) -> set:
+    '''
+    The YYYY-MM-DD dates whose granule changes have not been gridded yet, from this or earlier runs
+    '''
+    return {row['date'] for row in conn.execute('SELECT date FROM pending_dates')}
+
+
+def add_pending_dates(conn: sqlite3.Connection, dates):
+    conn.executemany('INSERT OR IGNORE INTO pending_dates VALUES (?)', [(str(date),) for date in dates])
+    conn.commit()
+
+
+def clear_pending_dates(conn: sqlite3.Connection, dates):
+    conn.executemany('DELETE FROM pending_dates WHERE date = ?', [(str(date),) for date in dates])
+    conn.commit()
+
+
+def granules_in_window(conn: sqlite3.Connection, start, end, mission=None) -> list:
+    """
+    Returns the catalog entries for granules dated within [start, end]. Entries are
+    ordered by date, with reference mission granules first within a date.
+
+    Params:
+        conn (Connection): sqlite connection to the catalog
+        start (datetime64): first day of the window
+        end (datetime64): last day of the window (inclusive)
+        mission (str): optionally restrict to a single dataset
+
+    Returns:
+        granules (List[dict]): path, mission, date, size, mtime and checksum of each granule
+    """
+    query = 'SELECT path, mission, date, size, mtime, checksum FROM granules WHERE date BETWEEN ? AND ?'
+    args = [str(start), str(end)]
+    if mission:
+        query += ' AND mission = ?'
+        args.append(mission)
+    query += ' ORDER BY date, mission != ?, path'
+    args.append(REF_MISSION)
+
+    return [dict(row) for row in conn.execute(query, args)]
+
+
+def mission_years(conn: sqlite3.Connection, mission: str) -> list:
+    return [row[0] for row in conn.execute(
+        'SELECT DISTINCT substr(date, 1, 4) FROM granules WHERE mission = ? ORDER BY 1', (mission,))]
+
+
+def mission_checksums(conn: sqlite3.Connection, mission: str) -> dict:
+    '''
+    The size, mtime and checksum of each of a mission's cataloged granules, keyed by path
+    '''
+    return {row['path']: (row['size'], row['mtime'], row['checksum']) for row in conn.execute(
+        'SELECT path, size, mtime, checksum FROM granules WHERE mission = ?', (mission,))}
+
+
+def mission_granule_count(conn: sqlite3.Connection, mission: str) -> int:
+    return conn.execute('SELECT COUNT(*) FROM granules WHERE mission = ?',
+                        (mission,)).fetchone()[0]
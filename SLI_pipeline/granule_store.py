@@ -0,0 +1,209 @@
+import logging
+import os
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from granule_catalog import granules_in_window, mission_years
+
+# Granule variable names mapped to their merged cycle names
+GRANULE_VARS = {'ssh': 'SSHA', 'lats': 'latitude', 'lons': 'longitude', 'time': 'time'}
+
+CHUNK_SIZE = 2 ** 16
+
+
+def decoded_dtype(dset):
+    '''
+    The dtype xarray would decode an HDF5 variable to. Packed values are unpacked to float64.
+    '''
+    if 'scale_factor' in dset.attrs or 'add_offset' in dset.attrs:
+        return np.dtype('float64')
+    if dset.dtype.kind != 'f':
+        return np.dtype('float64')
+    return dset.dtype
+
+
+def read_h5_var(dset, out):
+    """
+    Reads an HDF5 variable straight into a preallocated buffer, applying the
+    same fill value masking and unpacking xarray does on open.
+
+    Params:
+        dset (h5py.Dataset): the granule variable
+        out (ndarray): the buffer slice to fill
+    """
+    dset.read_direct(out)
+
+    attrs = dset.attrs
+    for fill_attr in ['_FillValue', 'missing_value']:
+        if fill_attr in attrs:
+            out[out == np.asarray(attrs[fill_attr]).ravel()[0]] = np.nan
+
+    if 'scale_factor' in attrs:
+        out *= np.asarray(attrs['scale_factor']).ravel()[0]
+    if 'add_offset' in attrs:
+        out += np.asarray(attrs['add_offset']).ravel()[0]
+
+
+def first_occurrences(times):
+    '''
+    Boolean mask keeping the first occurrence of each repeated time
+    '''
+    _, index = np.unique(times, return_index=True)
+    keep = np.zeros(len(times), dtype=bool)
+    keep[index] = True
+    return keep
+
+
+def read_granule(path) -> dict:
+    '''
+    Reads a whole granule, dropping repeated times and sorting by time
+    '''
+    with h5py.File(path, 'r') as f:
+        group = f['data']
+        data = {}
+        for var in GRANULE_VARS:
+            data[var] = np.empty(group[var].shape[0], dtype=decoded_dtype(group[var]))
+            read_h5_var(group[var], data[var])
+
+    keep = np.flatnonzero(first_occurrences(data['time']))
+    order = keep[np.argsort(data['time'][keep], kind='stable')]
+    return {var: values[order] for var, values in data.items()}
+
+
+def store_path(output_dir: Path, mission: str, year: str) -> Path:
+    return Path(output_dir) / 'datasets' / mission / 'consolidated' / f'{year}.h5'
+
+
+def day_number(date: str) -> int:
+    return int(np.datetime64(date, 'D').astype(int))
+
+
+def read_store_index(path: Path) -> dict:
+    """
+    Reads a consolidated store's day index.
+
+    Returns:
+        index (dict): day number -> (start, end, granule size, granule mtime)
+    """
+    if not path.exists():
+        return {}
+
+    with h5py.File(path, 'r') as f:
+        days = f['day'][:]
+        offsets = f['offset'][:]
+        sizes = f['size'][:]
+        mtimes = f['mtime'][:]
+
+    return {int(day): (int(offsets[i]), int(offsets[i + 1]), int(sizes[i]), float(mtimes[i]))
+            for i, day in enumerate(days)}
+
+
+def consolidate_mission_year(catalog, output_dir: Path, mission: str, year: str) -> bool:
+    """
+    Repacks a mission-year of daily granules into one chunked, time sorted columnar
+    file with a day offset index. Days whose granule is unchanged since the last
+    consolidation are copied from the previous store rather than reread.
+
+    Params:
+        catalog (Connection): the granule catalog
+        output_dir (Path): the pipeline output directory
+        mission (str): the dataset name
+        year (str): the YYYY year
+
+    Returns:
+        updated (bool): whether the store was rewritten
+    """
+    path = store_path(output_dir, mission, year)
+    granules = granules_in_window(catalog, f'{year}-01-01', f'{year}-12-31', mission)
+
+    old_index = read_store_index(path)
+    new_keys = {day_number(g['date']): (g['size'], g['mtime']) for g in granules}
+    if {day: entry[2:] for day, entry in old_index.items()} == new_keys:
+        return False
+
+    logging.info(f'Consolidating {mission} {year} granules')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+
+    old_store = h5py.File(path, 'r') if old_index else None
+    try:
+        with h5py.File(tmp_path, 'w') as f:
+            offsets = [0]
+            for granule in granules:
+                day = day_number(granule['date'])
+                old_entry = old_index.get(day)
+
+                if old_entry and old_entry[2:] == (granule['size'], granule['mtime']):
+                    data = {var: old_store[var][old_entry[0]:old_entry[1]] for var in GRANULE_VARS}
+                else:
+                    data = read_granule(granule['path'])
+
+                n = len(data['time'])
+                for var, values in data.items():
+                    if var not in f:
+                        f.create_dataset(var, shape=(0,), maxshape=(None,), dtype=values.dtype,
+                                         chunks=(CHUNK_SIZE,))
+                    f[var].resize((offsets[-1] + n,))
+                    f[var][offsets[-1]:] = values
+                offsets.append(offsets[-1] + n)
+
+            f['day'] = np.array([day_number(g['date']) for g in granules], dtype='int32')
+            f['offset'] = np.array(offsets, dtype='int64')
+            f['size'] = np.array([g['size'] for g in granules], dtype='int64')
+            f['mtime'] = np.array([g['mtime'] for g in granules], dtype='float64')
+    finally:
+        if old_store:
+            old_store.close()
+
+    os.replace(tmp_path, path)
+    return True
+
+
+def consolidate_mission(catalog, output_dir: Path, mission: str):
+    '''
+    Brings every consolidated year store for a mission up to date with the catalog
+    '''
+    for year in mission_years(catalog, mission):
+        try:
+            consolidate_mission_year(catalog, output_dir, mission, year)
+        except Exception as e:
+            logging.exception(f'Error consolidating {mission} {year} granules. {e}')
+
+
+def store_slices(cycle_granules) -> dict:
+    """
+    Finds the granules whose day is current in a consolidated store. A store is
+    only used when all of the window's days for that mission-year are current,
+    so they can be read as one contiguous slice.
+
+    Params:
+        cycle_granules (List[dict]): catalog entries for the granules to read
+
+    Returns:
+        slices (dict): granule path -> (store path, start, end) of its mission-year slice
+    """
+    by_store = {}
+    for granule in cycle_granules:
+        mission_dir = Path(granule['path']).parents[2]
+        path = mission_dir / 'consolidated' / f'{granule["date"][:4]}.h5'
+        by_store.setdefault(path, []).append(granule)
+
+    slices = {}
+    for path, granules in by_store.items():
+        index = read_store_index(path)
+        entries = [index.get(day_number(g['date'])) for g in granules]
+        if not all(entry and entry[2:] == (g['size'], g['mtime'])
+                   for g, entry in zip(granules, entries)):
+            continue
+
+        start = min(entry[0] for entry in entries)
+        end = max(entry[1] for entry in entries)
+        if sum(entry[1] - entry[0] for entry in entries) != end - start:
+            continue
+
+        for granule in granules:
+            slices[granule['path']] = (path, start, end)
+
+    return slices
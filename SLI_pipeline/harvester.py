@@ -1,13 +1,31 @@
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from glob import glob
 from pathlib import Path
 
 import yaml
 from webdav3.client import Client
+from webdav3.urn import Urn
 
-from conf.global_settings import FILE_FORMAT
+from conf.global_settings import CONSOLIDATED_STORE, HARVEST_RETRIES, HARVEST_WORKERS
+from granule_catalog import (file_md5, mission_checksums, mission_granule_count, open_catalog,
+                             sync_mission)
+from granule_store import consolidate_mission
+from listing_cache import (cache_entry, directory_state, load_listing_cache, load_md5_cache,
+                           needs_listing, save_listing_cache, save_md5_cache)
+
+# Seconds before the first retry of a failed download, doubling with each retry
+RETRY_BACKOFF = 2
+
+# Threads reading .md5 sidecars. They have their own pool, so a year's sidecars
+# are not queued behind the previous years' downloads.
+SIDECAR_WORKERS = 4
+
+# Per thread WebDAV clients, see thread_client
+_THREAD_CLIENTS = threading.local()
 
 
 def drive_connection() -> Client:
@@ -30,19 +48,165 @@ def drive_connection() -> Client:
 
     return client
 
-def podaac_drive_harvester(config: dict, target_dir: Path) -> dict:
+
+def thread_client() -> Client:
+    '''
+    The calling thread's WebDAV client. Each thread keeps its own client, so its
+    HTTP connections are pooled and reused across requests.
+    '''
+    if not hasattr(_THREAD_CLIENTS, 'client'):
+        _THREAD_CLIENTS.client = drive_connection()
+    return _THREAD_CLIENTS.client
+
+
+def list_year(webdav_ds_name: str, year: str) -> list:
+    '''
+    Lists a year directory's granules and .md5 sidecars with their modified time and size
+    '''
+    logging.info(f'Checking granules for {year}...This may take a while...')
+    files = thread_client().list(f'{webdav_ds_name}/{year}', get_info=True)[1:]
+    files.sort(key=lambda f: f['path'])
+    return files
+
+
+def fetch_md5(remote_path: str) -> str:
+    '''
+    Reads the checksum from a granule's .md5 sidecar
+    '''
+    response = thread_client().execute_request('download', Urn(remote_path).quote())
+    return response.text.split()[0].lower()
+
+
+def part_version_path(part_fp: Path) -> Path:
+    return part_fp.with_name(part_fp.name + '.modified')
+
+
+def part_version(part_fp: Path) -> str:
+    '''
+    The listing modified time of the granule version a .part file holds, or None
+    '''
+    try:
+        return part_version_path(part_fp).read_text() or None
+    except FileNotFoundError:
+        return None
+
+
+def fetch_granule(remote_path: str, part_fp: Path, modified: str = None):
+    """
+    Streams a granule into its partial download file. If the file already holds the
+    start of the granule only the remaining bytes are requested, with If-Range set to
+    the modified time saved when the file was started. A granule modified since then
+    is sent (and written) whole.
+
+    Params:
+        remote_path (str): the granule path on the drive
+        part_fp (Path): the partial download file
+        modified (str): the granule's modified time in the remote listing
+    """
+    version = part_version(part_fp)
+    offset = part_fp.stat().st_size if part_fp.exists() and version else 0
+
+    headers = None
+    if offset:
+        headers = [f'Range: bytes={offset}-', f'If-Range: {version}']
+
+    response = thread_client().execute_request('download', Urn(remote_path).quote(),
+                                               headers_ext=headers)
+
+    # Anything but a partial response is the whole granule
+    mode = 'ab' if offset and response.status_code == 206 else 'wb'
+    if mode == 'wb':
+        part_version_path(part_fp).write_text(modified or '')
+    with open(part_fp, mode) as f:
+        for chunk in response.iter_content(chunk_size=1 << 16):
+            f.write(chunk)
+
+
+def download_granule(remote_path: str, local_fp: Path, expected_size: int,
+                     checksum: str = None, modified: str = None,
+                     retries: int = HARVEST_RETRIES) -> bool:
+    """
+    Downloads a granule to a .part file next to it, resuming any earlier partial
+    download of the same version of the granule. The listing's modified time is saved
+    next to the .part file, and a .part file of another version is discarded. Once
+    its size matches the remote listing, and its md5 the remote sidecar if there is
+    one, the .part file is renamed into place. Interrupted downloads are resumed after
+    RETRY_BACKOFF, 2 * RETRY_BACKOFF, ... seconds, and corrupt ones restarted.
+
+    Params:
+        remote_path (str): the granule path on the drive
+        local_fp (Path): where the granule is saved
+        expected_size (int): the granule's size in the remote listing
+        checksum (str): the granule's md5 from its sidecar, or None
+        modified (str): the granule's modified time in the remote listing
+        retries (int): number of retries after the first attempt
+
+    Returns:
+        success (bool): whether a complete granule was downloaded
+    """
+    part_fp = local_fp.with_name(local_fp.name + '.part')
+
+    if part_fp.exists() and (modified is None or part_version(part_fp) != modified):
+        logging.info(f'{local_fp.name} changed since its partial download. Restarting')
+        os.remove(part_fp)
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+        try:
+            if not part_fp.exists() or part_fp.stat().st_size < expected_size:
+                fetch_granule(remote_path, part_fp, modified)
+
+            # Make sure file properly downloaded by comparing sizes and checksums
+            part_size = part_fp.stat().st_size
+            if expected_size == part_size and \
+                    (checksum is None or checksum == file_md5(part_fp)):
+                os.replace(part_fp, local_fp)
+                part_version_path(part_fp).unlink(missing_ok=True)
+                return True
+
+            if part_size >= expected_size:
+                logging.error(f'{local_fp.name} corrupt download. Removing file')
+                os.remove(part_fp)
+            else:
+                logging.info(f'{local_fp.name} incomplete download ({part_size} of {expected_size} bytes)')
+
+        except Exception as e:
+            logging.info(f'{local_fp.name} download attempt {attempt + 1} failed. {e}')
+
+            # Start the next attempt on fresh connections
+            vars(_THREAD_CLIENTS).pop('client', None)
+
+    return False
+
+
+def podaac_drive_harvester(config: dict, target_dir: Path, workers: int = HARVEST_WORKERS,
+                           refresh_listings: bool = False, local_checksums: dict = None) -> dict:
     """
     Harvests new or updated granules from PODAAC for a specific dataset, within a
     specific date range. Creates new or modifies granule docs for each harvested granule.
+    Year directories are listed and granules downloaded by a pool of worker threads.
+    Year directory listings are cached in the dataset directory and only relisted
+    as decided by listing_cache.needs_listing.
+
+    Granules with a remote .md5 sidecar are only downloaded if the sidecar's checksum
+    differs from the local granule's cataloged checksum. Sidecars are read a year at a
+    time by their own SIDECAR_WORKERS threads and cached in the dataset directory
+    until they are modified.
 
     Params:
         config (dict): the dataset specific config file
         target_dir (Path): the path of the dataset's harvested granules directory
+        workers (int): number of concurrent listings and downloads
+        refresh_listings (bool): relist every year directory, ignoring the cache
+        local_checksums (dict): (size, mtime, checksum) of the local granules by path,
+                                from granule_catalog.mission_checksums
 
     Returns:
         stats (dict): Dictionary containing harvesting statistics
     """
-    client = drive_connection()
+    client = thread_client()
 
     ds_name = config['ds_name']
     if ds_name == 'MERGED_ALT':
@@ -57,10 +221,18 @@ def podaac_drive_harvester(config: dict, target_dir: Path) -> dict:
     end_year = end_time[:4]
 
     years_range = list(range(int(start_year), int(end_year)+1))
-    ds_years = client.list(webdav_ds_name)[1:]
-    ds_years = [y for y in ds_years if int(y[:-1]) in years_range]
+    year_states = {entry['path'].rstrip('/').split('/')[-1] + '/': directory_state(entry)
+                   for entry in client.list(webdav_ds_name, get_info=True)[1:]}
+    ds_years = [y for y in year_states if int(y[:-1]) in years_range]
     ds_years.sort()
 
+    cache = load_listing_cache(target_dir.parent)
+    cache = {year: cache[year] for year in ds_years if year in cache}
+    open_ended = config['end'] == 'now'
+
+    md5_cache = load_md5_cache(target_dir.parent)
+    local_checksums = local_checksums or {}
+
     def date_filter(f):
         date = f['path'].split('_')[-1].split('.')[0][3:]
         start = start_time
@@ -71,66 +243,96 @@ def podaac_drive_harvester(config: dict, target_dir: Path) -> dict:
 
     stats = {'expected_files': 0}
 
-    for year in ds_years:
-        logging.info(f'Checking granules for {year}...This may take a while...')
-        files = client.list(f'{webdav_ds_name}/{year}', get_info=True)[1:]
-        files = [f for f in files if 'md5' not in f['path']]
-        files.sort(key=lambda f: f['path'])
-        files = list(filter(date_filter, files))
-        stats['expected_files'] += len(files)
-
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            ThreadPoolExecutor(max_workers=SIDECAR_WORKERS) as sidecar_executor:
+        listings = {year: executor.submit(list_year, webdav_ds_name, year) for year in ds_years
+                    if needs_listing(cache.get(year), year_states[year], year, open_ended,
+                                     refresh_listings)}
+        logging.info(f'{ds_name}: listing {len(listings)} of {len(ds_years)} year directories')
+
+        downloads = {}
+        for year in ds_years:
+            if year in listings:
+                files = listings[year].result()
+                cache[year] = cache_entry(year_states[year], files)
+            else:
+                files = cache[year]['files']
 
-        local_dir = (target_dir / year)
-        local_dir.mkdir(parents=True, exist_ok=True)
+            sidecars = {f['path'][:-len('.md5')]: f for f in files if f['path'].endswith('.md5')}
+            files = [f for f in files if 'md5' not in f['path']]
+            files = list(filter(date_filter, files))
+            stats['expected_files'] += len(files)
 
-        for f in files:
-            updating = False
+            local_dir = (target_dir / year)
+            local_dir.mkdir(parents=True, exist_ok=True)
 
-            pod_name = f['path'].split('/')[-1]
-            filename = f['path'].split('_')[-1]
-            remote_path = f'{webdav_ds_name}{year}{pod_name}'
-            
-            datetime_modified = datetime.strptime(
-                f['modified'], '%a, %d %b %Y %H:%M:%S %Z')
+            # Read the year's new or modified sidecars at once
+            fetches = {}
+            for f in files:
+                sidecar = sidecars.get(f['path'])
+                if sidecar and md5_cache.get(sidecar['path'], {}).get('modified') != sidecar['modified']:
+                    remote_sidecar = f'{webdav_ds_name}{year}{sidecar["path"].split("/")[-1]}'
+                    fetches[sidecar['path']] = (sidecar, sidecar_executor.submit(fetch_md5, remote_sidecar))
 
-            local_fp = local_dir / filename
+            for path, (sidecar, future) in fetches.items():
+                try:
+                    md5_cache[path] = {'modified': sidecar['modified'], 'md5': future.result()}
+                except Exception as e:
+                    logging.info(f'Unable to read {path}. {e}')
 
-            if local_fp.exists():
-                local_mod_time = datetime.fromtimestamp(os.path.getmtime(local_fp))
-                local_size = local_fp.stat().st_size
+            for f in files:
+                updating = False
 
-            expected_size = f['size']
+                pod_name = f['path'].split('/')[-1]
+                filename = f['path'].split('_')[-1]
+                remote_path = f'{webdav_ds_name}{year}{pod_name}'
 
-            updating = (not local_fp.exists()) or \
-                (str(local_mod_time) <= str(datetime_modified)) or \
-                    (int(expected_size) != local_size)
+                datetime_modified = datetime.strptime(
+                    f['modified'], '%a, %d %b %Y %H:%M:%S %Z')
 
-            if updating:
-                logging.info(f'Downloading {ds_name} {filename}')
-                try:
-                    client.download_file(remote_path, local_fp)
+                local_fp = local_dir / filename
 
+                if local_fp.exists():
+                    local_mod_time = datetime.fromtimestamp(os.path.getmtime(local_fp))
                     local_size = local_fp.stat().st_size
 
-                    # Make sure file properly downloaded by comparing sizes
-                    if int(expected_size) != local_size:
-                        logging.error(f'{ds_name} {filename} incomplete download. Removing file')
-                        os.remove(local_fp)
+                expected_size = f['size']
 
-                except Exception as e:
-                    logging.info(f'{ds_name} harvesting error! {filename} failed to download')
-                    logging.exception(e)
+                sidecar = sidecars.get(f['path'])
+                remote_md5 = md5_cache.get(sidecar['path'], {}).get('md5') if sidecar else None
 
-            else:
-                logging.info(f'{ds_name} {filename} already up to date')
+                # The local checksum only counts if the granule is unchanged since it was cataloged
+                local_entry = local_checksums.get(str(local_fp))
+                local_md5 = local_entry[2] if local_fp.exists() and local_entry and \
+                    local_entry[:2] == (local_size, os.path.getmtime(local_fp)) else None
+
+                if remote_md5 and local_md5:
+                    updating = remote_md5 != local_md5
+                else:
+                    updating = (not local_fp.exists()) or \
+                        (str(local_mod_time) <= str(datetime_modified)) or \
+                            (int(expected_size) != local_size)
+
+                if updating:
+                    logging.info(f'Downloading {ds_name} {filename}')
+                    future = executor.submit(download_granule, remote_path, local_fp,
+                                             int(expected_size), remote_md5, f['modified'])
+                    downloads[future] = filename
+                else:
+                    logging.info(f'{ds_name} {filename} already up to date')
 
-    stats['actual_files'] = len(glob(f'{target_dir}/**/*{FILE_FORMAT}', recursive=True))
+        for future in as_completed(downloads):
+            if not future.result():
+                logging.info(f'{ds_name} harvesting error! {downloads[future]} failed to download')
+
+    save_listing_cache(target_dir.parent, cache)
+    save_md5_cache(target_dir.parent, md5_cache)
 
     return stats
 
 # https://podaac-tools.jpl.nasa.gov/drive-r/files/merged_alt/shared/L2/int/sentinel-6a/2020/SNTNL-6A-alt_ssh20201218.h5
 # https://podaac-tools.jpl.nasa.gov/drive-r/files/merged_alt/shared/L2/int/merged_alt/1993/MERGED_ALT-alt_ssh19930101.h5
-def harvester(config: dict, output_path: Path) -> str:
+def harvester(config: dict, output_path: Path, refresh_listings: bool = False) -> str:
     """
     Harvests new or updated granules from a local drive for a dataset. Posts granule metadata docs
     to Solr and creates or updates dataset metadata doc.
@@ -139,15 +341,34 @@ def harvester(config: dict, output_path: Path) -> str:
     Params:
         config (dict): the dataset specific config file
         output_path (Path): the existing granule docs on Solr in dict format
+        refresh_listings (bool): relist every remote year directory, ignoring the listing cache
+
+    Returns:
+        harvest_status (str): summary of the harvest. The dates of the granules added,
+                              changed or removed are queued in the granule catalog.
     """
     ds_name = config['ds_name']
 
     target_dir = output_path / 'datasets' / ds_name / 'harvested_granules'
     target_dir.mkdir(parents=True, exist_ok=True)
 
-    print(f'Harvesting {ds_name} files to {target_dir}\n')
+    logging.info(f'Harvesting {ds_name} files to {target_dir}')
+
+    catalog = open_catalog(output_path)
+    local_checksums = mission_checksums(catalog, ds_name)
+    catalog.close()
+
+    stats = podaac_drive_harvester(config, target_dir, refresh_listings=refresh_listings,
+                                   local_checksums=local_checksums)
+
+    # Keep the granule catalog in line with what is now on disk
+    catalog = open_catalog(output_path)
+    sync_mission(catalog, output_path, ds_name)
+    stats['actual_files'] = mission_granule_count(catalog, ds_name)
 
-    stats = podaac_drive_harvester(config, target_dir)
+    if CONSOLIDATED_STORE:
+        consolidate_mission(catalog, output_path, ds_name)
+    catalog.close()
 
     logging.info(f'{ds_name} harvesting: {stats["expected_files"]} expected files. {stats["actual_files"]} files harvested.')
 
@@ -0,0 +1,208 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+from netCDF4 import Dataset, default_fillvals
+
+from conf.global_settings import INDICATOR_MEMORY_BUDGET
+
+TIME_UNITS = 'seconds since 1970-01-01 00:00:00'
+
+
+def store_path(indicator_dir: Path, product: str) -> Path:
+    return Path(indicator_dir) / 'stores' / f'{product}.nc'
+
+
+def open_store(path: Path) -> Dataset:
+    '''
+    Opens a product store for appending, creating it with an unlimited time dimension if needed
+    '''
+    if path.exists():
+        return Dataset(path, 'a')
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    nc = Dataset(path, 'w')
+    nc.createDimension('time', None)
+
+    time_var = nc.createVariable('time', 'f8', ('time',))
+    time_var.units = TIME_UNITS
+    time_var.calendar = 'proleptic_gregorian'
+
+    # Slots of cycles that were removed or never written stay 0
+    nc.createVariable('valid', 'i1', ('time',), fill_value=0)
+    return nc
+
+
+def time_value(time) -> float:
+    return float(np.asarray(time).astype('datetime64[s]').astype(np.float64))
+
+
+def cycle_slot(nc: Dataset, value: float) -> int:
+    '''
+    The time index holding a cycle, or the next free index if the cycle is new
+    '''
+    times = np.ma.filled(nc['time'][:], np.nan)
+    slots = np.flatnonzero(times == value)
+    return int(slots[0]) if len(slots) else len(times)
+
+
+def create_variable(nc: Dataset, ds: xr.Dataset, name: str):
+    '''
+    Adds a time varying float32 variable shaped like one of ds's data variables,
+    along with any of its spatial dimensions and coordinates the store lacks
+    '''
+    da = ds[name]
+
+    for dim in da.dims:
+        if dim not in nc.dimensions:
+            nc.createDimension(dim, da.sizes[dim])
+            coord_var = nc.createVariable(dim, 'f4', (dim,))
+            coord_var.setncatts(ds[dim].attrs)
+            coord_var[:] = ds[dim].values
+
+    var = nc.createVariable(name, 'f4', ('time',) + da.dims,
+                            zlib=True, complevel=5, shuffle=True,
+                            chunksizes=(1,) + da.shape if da.dims else None,
+                            fill_value=default_fillvals['f4'])
+    var.setncatts(da.attrs)
+
+
+def write_cycle(path: Path, ds: xr.Dataset):
+    """
+    Writes one cycle's values into its time slice of a product store, replacing
+    the slice in place if the cycle was written before and appending otherwise.
+    The store's global attributes are those of the cycle it was created with.
+
+    Params:
+        path (Path): the product store
+        ds (Dataset): the cycle's values, with a scalar time coordinate
+    """
+    value = time_value(ds.time.values)
+    created = not path.exists()
+
+    with open_store(path) as nc:
+        slot = cycle_slot(nc, value)
+
+        for name in ds.data_vars:
+            if name not in nc.variables:
+                create_variable(nc, ds, name)
+            nc[name][slot] = np.asarray(ds[name].values, dtype=np.float32)
+
+        nc['time'][slot] = value
+        nc['valid'][slot] = 1
+        if created:
+            nc.setncatts(ds.attrs)
+
+
+def remove_cycles(path: Path, dates):
+    '''
+    Flags the time slices of the given cycles as removed
+    '''
+    if not path.exists():
+        return
+
+    with Dataset(path) as nc:
+        times = np.ma.filled(nc['time'][:], np.nan)
+    slots = [slot for date in dates
+             for slot in np.flatnonzero(times == time_value(np.datetime64(date)))[:1]]
+
+    # Opening the store for writing marks it changed, see write_product
+    if slots:
+        with open_store(path) as nc:
+            for slot in slots:
+                nc['valid'][slot] = 0
+
+
+def valid_slots(nc: Dataset) -> np.ndarray:
+    '''
+    Indices of a store's valid time slices in time order
+    '''
+    times = np.ma.filled(nc['time'][:], np.nan)
+    valid = np.flatnonzero(np.ma.filled(nc['valid'][:], 0) == 1)
+    return valid[np.argsort(times[valid], kind='stable')]
+
+
+def copy_variable(var, out, slots, memory_budget: int):
+    """
+    Copies the given time slices of a store variable into a product variable,
+    a slab of as many slices as fit in memory_budget bytes at a time.
+
+    Params:
+        var (Variable): the store variable
+        out (Variable): the product variable
+        slots (ndarray): the store time indices to copy, in product order
+        memory_budget (int): the maximum slab size in bytes
+    """
+    if 'time' not in var.dimensions:
+        out[:] = var[:]
+        return
+
+    # Every chunk is read and written exactly once, so the per variable HDF5
+    # chunk caches would only add to memory use
+    var.set_var_chunk_cache(size=0)
+    out.set_var_chunk_cache(size=0)
+
+    slice_bytes = var.dtype.itemsize * int(np.prod(var.shape[1:], dtype=np.int64))
+    step = max(1, memory_budget // max(slice_bytes, 1))
+
+    for start in range(0, len(slots), step):
+        slab_slots = slots[start:start + step]
+        slab = np.empty((len(slab_slots),) + var.shape[1:], dtype=var.dtype)
+        for i, slot in enumerate(slab_slots):
+            slab[i] = var[slot]
+        out[start:start + len(slab_slots)] = slab
+
+
+def write_product(path: Path, product_path: Path, memory_budget: int = INDICATOR_MEMORY_BUDGET):
+    """
+    Writes a combined product holding the valid cycles of a store in time order.
+    Values are streamed through in time slabs, so memory use is bounded by
+    memory_budget rather than the length of the record. The product is removed
+    if the store holds no valid cycles, and left as is if it was written after the
+    store last changed.
+
+    Params:
+        path (Path): the product store
+        product_path (Path): the combined product, ie: indicator/indicators.nc
+        memory_budget (int): the maximum slab size in bytes
+    """
+    if product_path.exists() and product_path.stat().st_mtime >= path.stat().st_mtime:
+        return
+
+    tmp_path = product_path.with_suffix('.tmp')
+
+    with Dataset(path) as store:
+        store.set_auto_mask(False)
+
+        slots = valid_slots(store)
+        if not len(slots):
+            if product_path.exists():
+                product_path.unlink()
+            return
+
+        with Dataset(tmp_path, 'w') as product:
+            product.set_auto_mask(False)
+            product.setncatts(store.__dict__)
+
+            for name, dim in store.dimensions.items():
+                product.createDimension(name, len(slots) if name == 'time' else len(dim))
+
+            for name, var in store.variables.items():
+                if name == 'valid':
+                    continue
+
+                filters = var.filters() or {}
+                gridded = var.dimensions[:1] == ('time',) and var.ndim > 1
+                out = product.createVariable(name, var.dtype, var.dimensions,
+                                             zlib=filters.get('zlib', False),
+                                             complevel=filters.get('complevel', 4),
+                                             shuffle=filters.get('shuffle', False),
+                                             chunksizes=(1,) + var.shape[1:] if gridded else None,
+                                             fill_value=getattr(var, '_FillValue', None))
+                out.setncatts({attr: var.getncattr(attr) for attr in var.ncattrs()
+                               if attr != '_FillValue'})
+
+                copy_variable(var, out, slots, memory_budget)
+
+    os.replace(tmp_path, product_path)
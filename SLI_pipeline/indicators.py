@@ -1,61 +1,92 @@
 from glob import glob
+import json
 import logging
 import os
 import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 from shutil import copyfile
 
 import numpy as np
 import xarray as xr
-from netCDF4 import default_fillvals
 
 with warnings.catch_warnings():
     warnings.simplefilter('ignore', UserWarning)
-    import pyresample as pr
     from pyresample.utils import check_and_wrap
 
+from conf.global_settings import INDICATOR_WORKERS, STORE_LINEAR_TREND
+from cycle_summary import load_summary
+from indicator_store import remove_cycles, store_path, write_cycle, write_product
+from ref_grid import ref_grid, ref_grid_dataset
 
+# Reference data for cycle_indicators, set by init_reference in this process and in each worker
+_REFERENCE = None
 
-def validate_counts(ds, threshold=0.9):
+
+def band_weights(lat_limit=66) -> dict:
     '''
-    Checks if counts average is above threshold value.
+    Flat indices and areas of the reference grid's wet cells within lat_limit degrees of the equator
     '''
-    counts = ds.sel(latitude=slice(-66, 66))['counts'].values
-    mean = np.nanmean(counts)
+    grid = ref_grid()
+    in_band = np.abs(np.asarray(grid['wet_lats'])) <= lat_limit
+    return {'index': np.asarray(grid['wet'])[in_band],
+            'area': np.asarray(grid['wet_area'])[in_band]}
 
-    if mean > threshold * 500:
-        return True
 
-    return False
+def band_mean(values, band):
+    """
+    Area weighted mean of the non-nan values over the wet cells of a latitude band.
 
+    Params:
+        values (ndarray): a (latitude, longitude) field or a (time, latitude, longitude) stack
+        band (dict): the band's flat indices and areas from band_weights
 
-def calc_linear_trend(ref_dir, cycle_ds):
-    trend_ds = xr.open_dataset(
-        ref_dir / 'BH_offset_and_trend_v0_new_grid.nc')
+    Returns:
+        mean (ndarray): the mean of the field, or of each field in the stack
+    """
+    values = np.asarray(values)
+    values = values.reshape(values.shape[:-2] + (-1,))[..., band['index']]
+
+    valid = ~np.isnan(values)
+    return np.matmul(np.where(valid, values, 0), band['area']) / np.matmul(valid, band['area'])
 
-    cycle_time = cycle_ds.time.values.astype('datetime64[D]')
+
+def counts_valid(mean_counts, threshold=0.9):
+    '''
+    Checks if a counts average is above threshold value.
+    '''
+    return mean_counts > threshold * 500
+
+
+def validate_counts(counts, band, threshold=0.9):
+    '''
+    Checks if counts average over the wet cells of the band is above threshold value.
+    '''
+    counts = np.asarray(counts)
+    mean = np.nanmean(counts.reshape(counts.shape[:-2] + (-1,))[..., band['index']], axis=-1)
+
+    return counts_valid(mean, threshold)
+
+
+def calc_linear_trend(cycle_time, reference, out=None):
+    '''
+    The linear trend field at the cycle's time from the preloaded BH offset and
+    trend fields, computed into out if given
+    '''
+    cycle_time = np.asarray(cycle_time).astype('datetime64[D]')
 
     time_diff = (cycle_time - np.datetime64('1992-10-02')
                  ).astype(np.int32) * 24 * 60 * 60
 
-    trend = time_diff * \
-        trend_ds['BH_sea_level_trend_meters_per_second'] + \
-        trend_ds['BH_sea_level_offset_meters']
+    trend = np.multiply(reference['trend'], time_diff, out=out)
+    trend += reference['offset']
 
     return trend
 
 
-def calc_spatial_mean(global_dam, ecco_latlon_grid, ct):
-    global_dam_slice = global_dam.sel(latitude=slice(-66, 66))
-    ecco_latlon_grid_slice = ecco_latlon_grid.sel(
-        latitude=slice(-66, 66))
-
-    nzp = np.where(~np.isnan(global_dam_slice), 1, np.nan)
-    area_nzp = np.sum(nzp * ecco_latlon_grid_slice.area)
-
-    spatial_mean = float(np.nansum(global_dam_slice *
-                         ecco_latlon_grid_slice.area) / area_nzp)
+def calc_spatial_mean(global_dam, band, ct):
+    spatial_mean = float(band_mean(global_dam.values, band))
 
     spatial_mean_da = xr.DataArray(spatial_mean, coords={'time': ct},
                                    attrs=global_dam.attrs)
@@ -65,15 +96,42 @@ def calc_spatial_mean(global_dam, ecco_latlon_grid, ct):
     return spatial_mean_da
 
 
-def calc_climate_index(agg_ds, pattern, pattern_ds, ann_cyc_in_pattern):
+def project_onto_pattern(pattern_field, ssha_stack):
+    """
+    Least squares fit of the pattern to each row of a stack of flattened pattern
+    region fields, over each row's valid points. The pattern is the only regressor,
+    so the fit is the closed form dot(pattern, row) / dot(pattern, pattern) and every
+    row is solved at once, whatever its data gaps.
+
+    Params:
+        pattern_field (ndarray): the pattern values
+        ssha_stack (ndarray): (n_rows, n_points) values to fit, nan where not fit
+
+    Returns:
+        index (ndarray): the fitted index of each row, nan for rows with no valid points
+    """
+    pattern_field = pattern_field.ravel()/1e3
+    ssha_stack = np.atleast_2d(ssha_stack).reshape(-1, pattern_field.size)
+
+    valid = ~np.isnan(ssha_stack)
+    num = np.sum(np.where(valid, ssha_stack * pattern_field, 0), axis=1)
+    den = np.sum(np.where(valid, pattern_field ** 2, 0), axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 0, num / den, np.nan)
+
+
+def calc_climate_index(agg_ds, pattern, geometry):
     """
+    Fits the pattern to a single cycle's anomaly and detrended fields. Cycles are
+    calculated one at a time (and in parallel, see indicators) and written into the
+    product stores as they finish, so the two fits of a cycle are solved together
+    with the closed form of project_onto_pattern rather than batched across cycles.
 
     Params:
         agg_ds (Dataset): the aggregated cycle Dataset object
         pattern (str): the name of the pattern
-        pattern_ds (Dataset): the actual pattern object
-        ann_cyc_in_pattern (Dict):
-        weights_dir (Path): the Path to the directory containing the stored pattern weights
+        geometry (dict): the pattern's geometry from pattern_geometry
     Returns:
         LS_result (List[float]):
         center_time (Datetime):
@@ -84,46 +142,28 @@ def calc_climate_index(agg_ds, pattern, pattern_ds, ann_cyc_in_pattern):
     # determine its month
     agg_ds_center_mon = int(str(center_time)[5:7])
 
-    pattern_field = pattern_ds[pattern][f'{pattern}_pattern'].values
+    pattern_field = geometry['field']
 
     ssha_da = agg_ds[f'SSHA_{pattern}_removed_global_linear_trend']
 
     # remove the monthly mean pattern from the gridded ssha
     # now ssha_anom is w.r.t. seasonal cycle and MDT
-    ssha_anom = ssha_da.values - \
-        ann_cyc_in_pattern[pattern].ann_pattern.sel(
-            month=agg_ds_center_mon).values/1e3
+    ssha_anom = ssha_da.values - geometry['ann'][agg_ds_center_mon - 1]
 
     # set ssha_anom to nan wherever the original pattern is nan
-    ssha_anom = np.where(
-        ~np.isnan(pattern_ds[pattern][f'{pattern}_pattern']), ssha_anom, np.nan)
+    ssha_anom = np.where(geometry['valid'], ssha_anom, np.nan)
 
-    # extract out all non-nan values of ssha_anom, these are going to
-    # be the points that we fit
+    # the non-nan values of ssha_anom are the points that we fit
     nonnans = ~np.isnan(ssha_anom)
-    ssha_anom_to_fit = ssha_anom[nonnans]
 
-    # do the same for the pattern
-    pattern_to_fit = pattern_field[nonnans]/1e3
-
-    # just for fun extract out same points from ssha, we'll see if
+    # just for fun fit the same points from ssha, we'll see if
     # removing the monthly climatology makes much of a difference
-    ssha_to_fit = ssha_da.copy(deep=True)
-    ssha_to_fit = ssha_da.values[nonnans]
-
-    X = np.vstack(np.array(pattern_to_fit))
+    ssha_to_fit = np.where(nonnans, ssha_da.values, np.nan)
 
-    # Good old Gauss
-    B_hat = np.matmul(np.matmul(np.linalg.inv(np.matmul(X.T, X)), X.T),
-                      ssha_anom_to_fit.T)
+    # both fits share the same points, so they are projected together
+    index, index_b = project_onto_pattern(pattern_field, np.stack([ssha_anom, ssha_to_fit]))
     offset = 0
-    index = B_hat[0]
-
-    # now minimize ssha_to_fit
-    B_hat = np.matmul(np.matmul(np.linalg.inv(np.matmul(X.T, X)), X.T),
-                      ssha_to_fit.T)
     offset_b = 0
-    index_b = B_hat[0]
 
     LS_result = [offset, index, offset_b, index_b]
 
@@ -137,319 +177,454 @@ def calc_climate_index(agg_ds, pattern, pattern_ds, ann_cyc_in_pattern):
     return LS_result, center_time, ssha_anom
 
 
-def save_files(date, output_dir, indicator_ds, globals_ds, pattern_and_anom_das):
-    ds_and_paths = []
+def label_indices(coords, labels):
+    '''
+    Integer indices of exact coordinate labels within a sorted coordinate array
+    '''
+    indices = np.clip(np.searchsorted(coords, labels), 0, len(coords) - 1)
+    if not np.array_equal(coords[indices], labels):
+        raise KeyError('Pattern coordinates are not on the global grid')
+    return indices
 
-    fp_date = date.replace('-', '_')
-    cycle_indicators_path = output_dir / 'cycle_indicators'
-    cycle_indicators_path.mkdir(parents=True, exist_ok=True)
-    indicator_output_path = cycle_indicators_path / f'{fp_date}_indicator.nc'
-    ds_and_paths.append((indicator_ds, indicator_output_path))
 
-    cycle_globals_path = output_dir / 'cycle_globals'
-    cycle_globals_path.mkdir(parents=True, exist_ok=True)
-    global_output_path = cycle_globals_path / f'{fp_date}_globals.nc'
-    ds_and_paths.append((globals_ds, global_output_path))
+def pattern_geometry(pattern_ds, pattern, ann_cyc_da, lats, lons) -> dict:
+    """
+    Resolves a pattern's region on the global grid once, so each cycle's values
+    in the region are extracted by plain array indexing.
 
-    for pattern in pattern_and_anom_das.keys():
-        pattern_anom_ds = pattern_and_anom_das[pattern]
-        pattern_anom_ds = pattern_anom_ds.expand_dims(
-            time=[pattern_anom_ds.time.values])
+    Params:
+        pattern_ds (Dataset): the pattern
+        pattern (str): the name of the pattern
+        ann_cyc_da (DataArray): the monthly sla climatology in the pattern's region
+        lats (ndarray): the global grid latitudes
+        lons (ndarray): the global grid longitudes
 
-        cycle_pattern_anoms_path = output_dir / 'cycle_pattern_anoms' / pattern
-        cycle_pattern_anoms_path.mkdir(parents=True, exist_ok=True)
-        pattern_anoms_output_path = cycle_pattern_anoms_path / \
-            f'{fp_date}_{pattern}_ssha_anoms.nc'
-        ds_and_paths.append((pattern_anom_ds, pattern_anoms_output_path))
+    Returns:
+        geometry (dict): lat_idx and lon_idx of the region on the global grid, their
+                         lats and lons, the pattern field, its static non-nan mask
+                         and the 12 monthly climatology slabs in meters
+    """
+    pattern_lons, pattern_lats = check_and_wrap(pattern_ds['Longitude'].values,
+                                                pattern_ds['Latitude'].values)
 
-    encoding_each = {'zlib': True,
-                     'complevel': 5,
-                     'dtype': 'float32',
-                     'shuffle': True,
-                     '_FillValue': default_fillvals['f8']}
+    lat_idx = label_indices(lats, pattern_lats)
+    lon_idx = label_indices(lons, pattern_lons)
 
-    for ds, path in ds_and_paths:
+    field = pattern_ds[f'{pattern}_pattern'].values
 
-        coord_encoding = {}
-        for coord in ds.coords:
-            coord_encoding[coord] = {'_FillValue': None,
-                                     'dtype': 'float32',
-                                     'complevel': 6}
+    geometry = {
+        'lat_idx': lat_idx,
+        'lon_idx': lon_idx,
+        'lats': lats[lat_idx],
+        'lons': lons[lon_idx],
+        'field': field,
+        'valid': ~np.isnan(field),
+        'ann': np.stack([ann_cyc_da.sel(month=month).values/1e3 for month in range(1, 13)])
+    }
+    return geometry
 
-        var_encoding = {
-            var: encoding_each for var in ds.data_vars}
 
-        encoding = {**coord_encoding, **var_encoding}
+def cycle_manifest_path(output_path):
+    return output_path / 'indicator' / 'cycle_manifest.json'
 
-        ds.to_netcdf(path, encoding=encoding)
-        ds.close()
 
-    return
+def load_cycle_manifest(output_path) -> dict:
+    try:
+        with open(cycle_manifest_path(output_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
 
-def concat_files(indicator_dir, type, pattern=''):
-    # Glob DAILY indicators
-    daily_path = indicator_dir / f'DAILY/cycle_{type}s' / pattern
-    daily_files = [x for x in daily_path.glob('*.nc') if x.is_file()]
-    daily_files.sort()
+def save_cycle_manifest(output_path, manifest):
+    path = cycle_manifest_path(output_path)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
 
-    files = daily_files
 
-    if pattern:
-        print(f' - Reading {pattern} files')
-    else:
-        print(f' - Reading {type} files')
+def grid_signature(grid) -> dict:
+    stat = os.stat(grid)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
 
-    all_ds = []
-    for c in files:
-        all_ds.append(xr.open_dataset(c))
+def cycle_signature(grid, cycle_summary) -> dict:
+    '''
+    Identifies a cycle's grid by its checksum from the gridded cycles summary,
+    or by its file size and mtime if it has no summary
+    '''
+    if cycle_summary:
+        return {'checksum': cycle_summary['checksum']}
+    return grid_signature(grid)
 
-    print(f' - Concatenating {type} files')
-    concat_ds = xr.concat(all_ds, dim='time')
-    all_ds = []
 
-    return concat_ds
+def cycle_changed(entry, grid, cycle_summary) -> bool:
+    '''
+    Checks if a cycle's grid changed since its manifest entry was recorded
+    '''
+    if entry is None:
+        return True
+    if cycle_summary and 'checksum' in entry:
+        return entry['checksum'] != cycle_summary['checksum']
+    return {k: entry.get(k) for k in ['size', 'mtime']} != grid_signature(grid)
 
 
-def indicators(output_path):
+def load_reference(patterns) -> dict:
     """
-    This function calculates indicator values for each regridded cycle. Those are
-    saved locally to avoid overloading memory. All locally saved indicator files 
-    are combined into a single netcdf spanning the entire 1992 - NOW time period.
+    Loads the read only reference data used by every cycle: the global grid, the
+    linear trend fields, the patterns and the monthly climatology in each pattern's region. Everything is
+    loaded into memory so workers forked afterwards share it without reopening files.
+
+    Params:
+        patterns (List[str]): the names of the patterns
+
+    Returns:
+        reference (dict): ecco_latlon_grid, the +-66 degree band weights, the BH
+                          trend and offset fields and the geometry of each pattern
     """
-    # Get all gridded cycles
-    grids = glob(f'{output_path}/gridded_cycles/*.nc')
-    grids.sort()
+    pattern_ds = dict()
+    pattern_geo_bnds = dict()
+    ann_cyc_in_pattern = dict()
+    geometry = dict()
 
-    update = False
+    ref_dir = Path().resolve().parent / 'ref_files'
 
-    # Check if we need to recalculate indicators
-    data_path = f'{output_path}/indicator/indicators.nc'
-    if os.path.exists(data_path):
-        ind_mod_time = datetime.fromtimestamp(os.path.getmtime(data_path))
-        for grid in grids:
-            grid_mod_time = datetime.fromtimestamp(os.path.getmtime(grid))
+    # Global grid
+    ecco_latlon_grid = ref_grid_dataset()
 
-            if grid_mod_time >= ind_mod_time:
-                update = True
+    # load the linear trend fields
+    with xr.open_dataset(ref_dir / 'BH_offset_and_trend_v0_new_grid.nc') as trend_ds:
+        trend = trend_ds['BH_sea_level_trend_meters_per_second'].values
+        offset = trend_ds['BH_sea_level_offset_meters'].values
 
-                backup_dir = Path(f'{output_path}/indicator/backups')
-                backup_dir.mkdir(parents=True, exist_ok=True)
+    if trend.shape != ecco_latlon_grid.mask.shape:
+        raise ValueError('BH offset and trend fields are not on the global grid')
 
-                # Copy old indicator file as backup
-                try:
-                    print('Making backup of existing indicator file.\n')
-                    backup_path = f'{backup_dir}/indicator_{ind_mod_time}.nc'
-                    copyfile(data_path, backup_path)
-                except Exception as e:
-                    logging.exception(f'Error creating indicator backup: {e}')
-                break
-    else:
-        update = True
-    
-    # ONLY PROCEED IF THERE ARE CYCLES NEEDING CALCULATING
-    if not update:
-        logging.info('No regridded cycles modified since last index calculation.')
-        return True
+    # load the monthly global sla climatology
+    with xr.open_dataset(ref_dir / 'ann_pattern.nc') as ann_ds:
 
-    logging.info('Calculating new index values for cycles.')
+        # load patterns and select out the monthly climatology of sla variation
+        # in each pattern
+        for pattern in patterns:
+            # load each pattern
+            pattern_fname = pattern + '_pattern_and_index.nc'
+            with xr.open_dataset(ref_dir / pattern_fname) as ds:
+                pattern_ds[pattern] = ds.load()
+
+            # get the geographic bounds of each sla pattern
+            pattern_geo_bnds[pattern] = [float(pattern_ds[pattern].Latitude[0].values),
+                                         float(
+                                             pattern_ds[pattern].Latitude[-1].values),
+                                         float(
+                                             pattern_ds[pattern].Longitude[0].values),
+                                         float(pattern_ds[pattern].Longitude[-1].values)]
+
+            # extract the sla annual cycle in the region of each pattern
+            ann_cyc_in_pattern[pattern] = ann_ds.sel(Latitude=slice(pattern_geo_bnds[pattern][0],
+                                                                    pattern_geo_bnds[pattern][1]),
+                                                     Longitude=slice(pattern_geo_bnds[pattern][2],
+                                                                     pattern_geo_bnds[pattern][3]))
+
+            geometry[pattern] = pattern_geometry(pattern_ds[pattern], pattern,
+                                                 ann_cyc_in_pattern[pattern].ann_pattern,
+                                                 ecco_latlon_grid.latitude.values,
+                                                 ecco_latlon_grid.longitude.values)
+
+    reference = {
+        'ecco_latlon_grid': ecco_latlon_grid,
+        'band': band_weights(),
+        'trend': trend,
+        'offset': offset,
+        'geometry': geometry
+    }
+    return reference
+
+
+def cycle_indicators(date, cycle, patterns, reference=None):
+    """
+    Calculates the indicators, global fields and pattern anomalies of a single
+    gridded cycle.
 
-    # ==============================================
-    # Pattern preparation
-    # ==============================================
+    Params:
+        date (str): the YYYY-MM-DD cycle date
+        cycle (str): path to the gridded cycle
+        patterns (List[str]): the names of the patterns
+        reference (dict): the reference data from load_reference. Defaults to
+                          the data loaded for the current run.
 
-    patterns = ['enso', 'pdo', 'iod']
+    Returns:
+        products (dict): product name -> Dataset of the cycle's values, or None
+                         if the cycle is missing too much data
+    """
+    reference = reference or _REFERENCE
+    ecco_latlon_grid = reference['ecco_latlon_grid']
+    geometry = reference['geometry']
 
-    pattern_ds = dict()
-    pattern_geo_bnds = dict()
-    ann_cyc_in_pattern = dict()
-    pattern_area_defs = dict()
+    cycle_ds = xr.open_dataset(cycle)
+    cycle_ds.close()
 
-    ref_dir = Path().resolve().parent / 'ref_files'
+    # Skip this grid if it's missing too much data
+    if not validate_counts(cycle_ds['counts'].values, reference['band']):
+        return None
 
-    # Global grid
-    ecco_fname = 'GRID_GEOMETRY_ECCO_V4r4_latlon_0p50deg.nc'
-    ecco_latlon_grid = xr.open_dataset(ref_dir / ecco_fname)
+    print(f' - Calculating index values for {date}')
 
-    global_lon = ecco_latlon_grid.longitude.values
-    global_lat = ecco_latlon_grid.latitude.values
-    global_lon_m, global_lat_m = np.meshgrid(global_lon, global_lat)
+    ct = np.datetime64(date)
 
-    pattern_area_defs['global'] = pr.geometry.SwathDefinition(lons=global_lon_m,
-                                                              lats=global_lat_m)
+    # Area mask the cycle data
+    global_dam = cycle_ds.where(ecco_latlon_grid.mask)['SSHA']
+    global_dam = global_dam.where(global_dam)
 
-    # load the monthly global sla climatology
-    ann_ds = xr.open_dataset(ref_dir / 'ann_pattern.nc')
+    global_dam.name = 'SSHA_GLOBAL'
+    global_dam.attrs['comment'] = 'Global SSHA land masked'
+    global_dsm = global_dam.to_dataset()
 
-    # load patterns and select out the monthly climatology of sla variation
-    # in each pattern
-    for pattern in patterns:
-        # load each pattern
-        pattern_fname = pattern + '_pattern_and_index.nc'
-        pattern_ds[pattern] = xr.open_dataset(ref_dir / pattern_fname)
-
-        # get the geographic bounds of each sla pattern
-        pattern_geo_bnds[pattern] = [float(pattern_ds[pattern].Latitude[0].values),
-                                     float(
-                                         pattern_ds[pattern].Latitude[-1].values),
-                                     float(
-                                         pattern_ds[pattern].Longitude[0].values),
-                                     float(pattern_ds[pattern].Longitude[-1].values)]
-
-        # extract the sla annual cycle in the region of each pattern
-        ann_cyc_in_pattern[pattern] = ann_ds.sel(Latitude=slice(pattern_geo_bnds[pattern][0],
-                                                                pattern_geo_bnds[pattern][1]),
-                                                 Longitude=slice(pattern_geo_bnds[pattern][2],
-                                                                 pattern_geo_bnds[pattern][3]))
-
-        # Individual Patterns
-        lon_m, lat_m = np.meshgrid(pattern_ds[pattern].Longitude.values,
-                                   pattern_ds[pattern].Latitude.values)
-        tmp_lon, tmp_lat = check_and_wrap(lon_m, lat_m)
-        pattern_area_defs[pattern] = pr.geometry.SwathDefinition(lons=tmp_lon,
-                                                                 lats=tmp_lat)
+    # Spatial Mean
+    mean_da = calc_spatial_mean(global_dam, reference['band'], ct)
 
-    # ==============================================
-    # Calculate indicators for each updated (re)gridded cycle
-    # ==============================================
+    global_dam_removed_mean = global_dam - mean_da.values
+    global_dam_removed_mean.attrs['comment'] = 'Global SSHA with global spatial mean removed'
+    global_dsm['SSHA_GLOBAL_removed_global_spatial_mean'] = global_dam_removed_mean
 
-    output_dir = output_path / 'indicator' / 'daily'
-    output_dir.mkdir(parents=True, exist_ok=True)
+    # Linear Trend. The trend field is derivable from the reference fields, so
+    # unless it's stored its buffer is detrended in place.
+    trend = calc_linear_trend(cycle_ds.time.values, reference)
+    if STORE_LINEAR_TREND:
+        global_dsm['SSHA_GLOBAL_linear_trend'] = (global_dam.dims, trend)
+        detrended = global_dam.values - trend
+    else:
+        detrended = np.subtract(global_dam.values, trend, out=trend)
 
-    for cycle in grids:
+    global_dam_detrended = global_dam.copy(data=detrended)
+    global_dam_detrended.attrs['comment'] = 'Global SSHA with linear trend removed'
+    global_dsm['SSHA_GLOBAL_removed_linear_trend'] = global_dam_detrended
 
-        try:
-            cycle_ds = xr.open_dataset(cycle)
-            cycle_ds.close()
+    if 'Z' in global_dsm.data_vars:
+        global_dsm = global_dsm.drop_vars('Z')
 
-            date = cycle.split('_')[-1][:8]
-            date = f'{date[:4]}-{date[4:6]}-{date[6:8]}'
+    pattern_and_anom_das = {}
 
-            # Skip this grid if it's missing too much data
-            if not validate_counts(cycle_ds):
-                logging.exception(
-                    f'Too much data missing from {date} cycle. Skipping.')
-                continue
+    all_indicators = []
 
-            print(f' - Calculating index values for {date}')
+    # Do the actual index calculation per pattern
+    for pattern in patterns:
+        # The pattern region by plain indexing of the detrended global field
+        detrended = global_dsm['SSHA_GLOBAL_removed_linear_trend']
+        region = np.ix_(geometry[pattern]['lat_idx'], geometry[pattern]['lon_idx'])
+
+        agg_da = xr.DataArray(detrended.values[region], dims=['latitude', 'longitude'],
+                              coords={'latitude': geometry[pattern]['lats'],
+                                      'longitude': geometry[pattern]['lons'],
+                                      'time': detrended.time.values},
+                              attrs=detrended.attrs)
+        agg_da.name = f'SSHA_{pattern}_removed_global_linear_trend'
+
+        agg_ds = agg_da.to_dataset()
+        agg_ds.attrs = cycle_ds.attrs
+
+        index_calc, ct,  ssha_anom = calc_climate_index(agg_ds, pattern,
+                                                        geometry[pattern])
 
-            ct = np.datetime64(date)
+        anom_name = f'SSHA_{pattern}_removed_global_linear_trend_and_seasonal_cycle'
+        ssha_anom.name = anom_name
 
-            # Area mask the cycle data
-            global_dam = cycle_ds.where(
-                ecco_latlon_grid.maskC.isel(Z=0) > 0)['SSHA']
-            global_dam = global_dam.where(global_dam)
+        agg_ds[anom_name] = ssha_anom
 
-            global_dam.name = 'SSHA_GLOBAL'
-            global_dam.attrs['comment'] = 'Global SSHA land masked'
-            global_dsm = global_dam.to_dataset()
+        # Handle patterns and anoms
+        pattern_and_anom_das[pattern] = agg_ds
 
-            # Spatial Mean
-            mean_da = calc_spatial_mean(global_dam, ecco_latlon_grid, ct)
+        # Handle indicators and offsets
+        indicator_da = xr.DataArray(index_calc[1], coords={'time': ct})
+        indicator_da.name = f'{pattern}_index'
+        all_indicators.append(indicator_da)
 
-            global_dam_removed_mean = global_dam - mean_da.values
-            global_dam_removed_mean.attrs['comment'] = 'Global SSHA with global spatial mean removed'
-            global_dsm['SSHA_GLOBAL_removed_global_spatial_mean'] = global_dam_removed_mean
+        offsets_da = xr.DataArray(index_calc[0], coords={'time': ct})
+        offsets_da.name = f'{pattern}_offset'
+        all_indicators.append(offsets_da)
 
-            # Linear Trend
-            trend = calc_linear_trend(ref_dir, cycle_ds)
-            global_dsm['SSHA_GLOBAL_linear_trend'] = trend
+    # Merge pattern indicators, offsets, and global spatial mean
+    all_indicators.append(mean_da)
+    indicator_ds = xr.merge(all_indicators)
 
-            global_dam_detrended = global_dam - trend
-            global_dam_detrended.attrs['comment'] = 'Global SSHA with linear trend removed'
-            global_dsm['SSHA_GLOBAL_removed_linear_trend'] = global_dam_detrended
+    globals_ds = global_dsm
 
-            if 'Z' in global_dsm.data_vars:
-                global_dsm = global_dsm.drop_vars('Z')
+    products = {'indicators': indicator_ds, 'globals': globals_ds}
+    for pattern in patterns:
+        products[f'{pattern}_anoms'] = pattern_and_anom_das[pattern]
 
-            pattern_and_anom_das = {}
+    return products
 
-            all_indicators = []
 
-            # Do the actual index calculation per pattern
-            for pattern in patterns:
-                pattern_lats = pattern_ds[pattern]['Latitude']
-                pattern_lats = pattern_lats.rename({'Latitude': 'latitude'})
-                pattern_lons = pattern_ds[pattern]['Longitude']
-                pattern_lons = pattern_lons.rename({'Longitude': 'longitude'})
-                pattern_lons, pattern_lats = check_and_wrap(pattern_lons,
-                                                            pattern_lats)
+def init_reference(reference):
+    '''
+    Makes the reference data the default for cycle_indicators in this process
+    '''
+    global _REFERENCE
+    _REFERENCE = reference
 
-                agg_da = global_dsm['SSHA_GLOBAL_removed_linear_trend'].sel(
-                    longitude=pattern_lons, latitude=pattern_lats)
-                agg_da.name = f'SSHA_{pattern}_removed_global_linear_trend'
 
-                agg_ds = agg_da.to_dataset()
-                agg_ds.attrs = cycle_ds.attrs
+def record_cycle(indicator_dir, manifest, removed_dates, date, signature, cycle_products):
+    """
+    Writes a cycle's results into the product stores and records it in the manifest.
 
-                index_calc, ct,  ssha_anom = calc_climate_index(agg_ds, pattern,
-                                                                pattern_ds,
-                                                                ann_cyc_in_pattern)
+    Params:
+        indicator_dir (Path): the indicator output directory
+        manifest (dict): the cycle manifest
+        removed_dates (List[str]): dates of cycles to remove from the stores
+        date (str): the YYYY-MM-DD cycle date
+        signature (dict): the cycle's signature from cycle_signature
+        cycle_products (dict): the cycle's results from cycle_indicators
+    """
+    if cycle_products is None:
+        logging.exception(
+            f'Too much data missing from {date} cycle. Skipping.')
+        manifest[date] = {**signature, 'valid': False}
+        removed_dates.append(date)
+        return
 
-                anom_name = f'SSHA_{pattern}_removed_global_linear_trend_and_seasonal_cycle'
-                ssha_anom.name = anom_name
+    # Write each product's values for this one cycle into its time slice
+    # of the product store
+    for product, ds in cycle_products.items():
+        write_cycle(store_path(indicator_dir, product), ds)
 
-                agg_ds[anom_name] = ssha_anom
+    manifest[date] = {**signature, 'valid': True}
 
-                # Handle patterns and anoms
-                pattern_and_anom_das[pattern] = agg_ds
 
-                # Handle indicators and offsets
-                indicator_da = xr.DataArray(index_calc[1], coords={'time': ct})
-                indicator_da.name = f'{pattern}_index'
-                all_indicators.append(indicator_da)
+def indicators(output_path, workers=INDICATOR_WORKERS):
+    """
+    This function calculates indicator values for each new or modified regridded
+    cycle. Those are written in place into the time slices of appendable product
+    stores, from which the combined netcdfs spanning the entire 1992 - NOW time
+    period are written.
+    """
+    # Get all gridded cycles
+    grids = glob(f'{output_path}/gridded_cycles/*.nc')
+    grids.sort()
 
-                offsets_da = xr.DataArray(index_calc[0], coords={'time': ct})
-                offsets_da.name = f'{pattern}_offset'
-                all_indicators.append(offsets_da)
+    grid_dates = {}
+    for grid in grids:
+        date = grid.split('_')[-1][:8]
+        grid_dates[f'{date[:4]}-{date[4:6]}-{date[6:8]}'] = grid
 
-            # Merge pattern indicators, offsets, and global spatial mean
-            all_indicators.append(mean_da)
-            indicator_ds = xr.merge(all_indicators)
-            indicator_ds = indicator_ds.expand_dims(
-                time=[indicator_ds.time.values])
+    indicator_dir = output_path / 'indicator'
+    patterns = ['enso', 'pdo', 'iod']
+    products = ['indicators', 'globals'] + [f'{pattern}_anoms' for pattern in patterns]
+
+    # Each cycle's grid checksum (or file size and mtime for cycles without a
+    # summary) when its indicators were calculated. Everything is recalculated
+    # if any product store is missing.
+    manifest = load_cycle_manifest(output_path)
+    if not all(store_path(indicator_dir, product).exists() for product in products):
+        manifest = {}
+
+    # Summary statistics recorded by cycle_gridding
+    summary = load_summary(output_path)
+
+    # Check which cycles need (re)calculating
+    pending = {}
+    upgraded = False
+    for date, grid in grid_dates.items():
+        entry = manifest.get(date)
+        if cycle_changed(entry, grid, summary.get(date)):
+            pending[date] = grid
+        elif 'checksum' not in entry and date in summary:
+            # Unchanged since before it had a summary
+            manifest[date] = {**cycle_signature(grid, summary[date]), 'valid': entry['valid']}
+            upgraded = True
+    removed = [date for date in manifest if date not in grid_dates]
+
+    update = bool(pending or removed) or \
+        not all((indicator_dir / f'{product}.nc').exists() for product in products)
 
-            globals_ds = global_dsm
-            globals_ds = globals_ds.expand_dims(time=[globals_ds.time.values])
+    data_path = f'{output_path}/indicator/indicators.nc'
+    if update and os.path.exists(data_path):
+        ind_mod_time = datetime.fromtimestamp(os.path.getmtime(data_path))
 
-            # Save indicators ds, global ds, and individual pattern ds for this one cycle
-            save_files(date, output_dir, indicator_ds,
-                       globals_ds, pattern_and_anom_das)
+        backup_dir = Path(f'{output_path}/indicator/backups')
+        backup_dir.mkdir(parents=True, exist_ok=True)
 
+        # Copy old indicator file as backup
+        try:
+            print('Making backup of existing indicator file.\n')
+            backup_path = f'{backup_dir}/indicator_{ind_mod_time}.nc'
+            copyfile(data_path, backup_path)
         except Exception as e:
-            logging.exception(e)
+            logging.exception(f'Error creating indicator backup: {e}')
+
+    # ONLY PROCEED IF THERE ARE CYCLES NEEDING CALCULATING
+    if not update:
+        logging.info('No regridded cycles modified since last index calculation.')
+        if upgraded:
+            save_cycle_manifest(output_path, manifest)
+        return True
+
+    logging.info(f'Calculating new index values for {len(pending)} cycles.')
+
+    # ==============================================
+    # Calculate indicators for each updated (re)gridded cycle
+    # ==============================================
+
+    # Cycles whose slices are removed from the product stores
+    removed_dates = list(removed)
+
+    signatures = {date: cycle_signature(cycle, summary.get(date)) for date, cycle in pending.items()}
+
+    # Skip cycles missing too much data without opening their grids
+    for date in list(pending):
+        if date in summary and not counts_valid(summary[date]['band_mean_counts']):
+            record_cycle(indicator_dir, manifest, removed_dates, date, signatures[date], None)
+            del pending[date]
+
+    # Loaded once and handed to each worker as it starts, whatever the start method
+    if pending:
+        reference = load_reference(patterns)
+        init_reference(reference)
+
+    if workers > 1 and len(pending) > 1:
+        logging.info(f'Calculating indicators with {workers} workers')
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_reference,
+                                 initargs=(reference,)) as executor:
+            futures = {executor.submit(cycle_indicators, date, cycle, patterns): date
+                       for date, cycle in pending.items()}
+
+            for future in as_completed(futures):
+                date = futures[future]
+                try:
+                    record_cycle(indicator_dir, manifest, removed_dates, date,
+                                 signatures[date], future.result())
+                except Exception as e:
+                    logging.exception(e)
+    else:
+        for date, cycle in pending.items():
+            try:
+                record_cycle(indicator_dir, manifest, removed_dates, date,
+                             signatures[date], cycle_indicators(date, cycle, patterns))
+            except Exception as e:
+                logging.exception(e)
 
     print('\nCycle index calculation complete. ')
     print('Merging and saving final indicator products.\n')
 
     # ==============================================
-    # Combine DAILY indicator files
+    # Write the combined indicator files from the product stores
     # ==============================================
 
     try:
-        indicator_dir = output_path / 'indicator'
-
-        # open_mfdataset is too slow so we glob instead
-        indicators = concat_files(indicator_dir, 'indicator')
-        print(' - Saving indicator file\n')
-        indicators.to_netcdf(indicator_dir / 'indicators.nc')
-
-        for pattern in patterns:
-            pattern_anoms = concat_files(
-                indicator_dir, 'pattern_anom', pattern)
-            print(f' - Saving {pattern} anom file\n')
-            pattern_anoms.to_netcdf(indicator_dir / f'{pattern}_anoms.nc')
+        for date in removed:
+            manifest.pop(date)
 
-            pattern_anoms = None
+        for product in products:
+            remove_cycles(store_path(indicator_dir, product), removed_dates)
 
-        globals_ds = concat_files(indicator_dir, 'global')
-        print(' - Saving global file\n')
-        globals_ds.to_netcdf(indicator_dir / 'globals.nc')
+            print(f' - Saving {product} file\n')
+            write_product(store_path(indicator_dir, product),
+                          indicator_dir / f'{product}.nc')
 
-        globals_ds = None
+        save_cycle_manifest(output_path, manifest)
 
     except Exception as e:
         logging.exception(e)
         return False
 
-    return True
\ No newline at end of file
+    return True
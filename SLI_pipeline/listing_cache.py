@@ -0,0 +1,88 @@
+import json
+import os
+from datetime import datetime
+
+from conf.global_settings import LISTING_REFRESH_YEARS
+
+# Listing fields kept for each remote file
+FILE_FIELDS = ['path', 'size', 'modified']
+
+
+def cache_path(dataset_dir):
+    return dataset_dir / 'listing_cache.json'
+
+
+def load_listing_cache(dataset_dir) -> dict:
+    try:
+        with open(cache_path(dataset_dir)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_listing_cache(dataset_dir, cache):
+    path = cache_path(dataset_dir)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def md5_cache_path(dataset_dir):
+    return dataset_dir / 'remote_md5.json'
+
+
+def load_md5_cache(dataset_dir) -> dict:
+    '''
+    The checksums read from remote .md5 sidecars, keyed by sidecar path, with
+    the sidecars' modified time when they were read
+    '''
+    try:
+        with open(md5_cache_path(dataset_dir)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_md5_cache(dataset_dir, md5_cache):
+    path = md5_cache_path(dataset_dir)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(md5_cache, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def directory_state(entry: dict) -> dict:
+    '''
+    The parts of a remote directory's listing entry that change when its contents do
+    '''
+    return {'modified': entry.get('modified'), 'etag': entry.get('etag')}
+
+
+def needs_listing(cached: dict, state: dict, year: str, open_ended: bool, force: bool = False) -> bool:
+    """
+    Checks if a remote year directory has to be listed again, or if its cached
+    listing can be used. Years never listed, years whose directory state changed
+    and the last LISTING_REFRESH_YEARS years of open ended datasets are relisted.
+
+    Params:
+        cached (dict): the year's cache entry, or None
+        state (dict): the year directory's current state from directory_state
+        year (str): the year directory name, ie: 2002/
+        open_ended (bool): whether the dataset's end is 'now'
+        force (bool): relist regardless of the cache
+
+    Returns:
+        relist (bool): whether the directory needs listing
+    """
+    if force or cached is None or cached['state'] != state:
+        return True
+    return open_ended and int(year.strip('/')) > datetime.utcnow().year - LISTING_REFRESH_YEARS
+
+
+def cache_entry(state: dict, files: list) -> dict:
+    return {
+        'state': state,
+        'listed': datetime.utcnow().isoformat(timespec='seconds'),
+        'files': [{k: f[k] for k in FILE_FIELDS} for f in files]
+    }
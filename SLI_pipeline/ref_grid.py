@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import warnings
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+from scipy.spatial import cKDTree
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', UserWarning)
+    import pyresample as pr
+
+from conf.global_settings import OUTPUT_DIR, PERSIST_REF_GRID
+from gauss_kdtree import EARTH_RADIUS, lonlat_to_xyz
+
+REF_DIR = Path().resolve().parent / 'ref_files'
+ECCO_FNAME = 'GRID_GEOMETRY_ECCO_V4r4_latlon_0p50deg.nc'
+BUNDLE_DIR = OUTPUT_DIR / 'ref_grid'
+
+ARRAYS = ['lon', 'lat', 'mask', 'area', 'wet', 'wet_lons', 'wet_lats', 'wet_area', 'wet_xyz']
+
+# Resolution in degrees of the along track coverage lookup
+COVERAGE_RES = 0.25
+
+# Process-wide reference grid, built on first use. Workers forked after it is
+# built share it (and the memory-mapped bundle pages) without reloading.
+_REF_GRID = None
+_COVERAGE = {}
+
+
+def build_ref_grid(ecco_path: Path) -> dict:
+    """
+    Derives the target grid geometry from the ECCO 0.5 degree grid file.
+
+    Params:
+        ecco_path (Path): path to the ECCO grid geometry file
+
+    Returns:
+        grid (dict): 1D lon and lat coordinates, 2D wet mask and area, the flat
+                     indices of wet cells and the lons, lats, areas and cartesian
+                     coordinates of those cells
+    """
+    with xr.open_dataset(ecco_path) as ecco_ds:
+        lon = ecco_ds.longitude.values
+        lat = ecco_ds.latitude.values
+        mask = ecco_ds.maskC.isel(Z=0).values > 0
+        area = ecco_ds.area.values
+
+    wet = np.where(mask.ravel())[0]
+
+    lon_m, lat_m = np.meshgrid(lon, lat)
+
+    grid = {
+        'lon': lon,
+        'lat': lat,
+        'mask': mask,
+        'area': area,
+        'wet': wet,
+        'wet_lons': lon_m.ravel()[wet],
+        'wet_lats': lat_m.ravel()[wet],
+        'wet_area': area.ravel()[wet],
+        'wet_xyz': lonlat_to_xyz(lon_m.ravel()[wet], lat_m.ravel()[wet])
+    }
+    return grid
+
+
+def save_bundle(grid: dict, bundle_dir: Path, source_mtime: float):
+    '''
+    Saves the grid arrays as .npy files so later runs can memory map them
+    '''
+    bundle_dir.mkdir(parents=True, exist_ok=True)
+    for name in ARRAYS:
+        np.save(bundle_dir / f'{name}.npy', grid[name])
+
+    with open(bundle_dir / 'meta.json', 'w') as f:
+        json.dump({'source_mtime': source_mtime}, f)
+
+
+def load_bundle(bundle_dir: Path, source_mtime: float):
+    '''
+    Memory maps a saved bundle. Returns None if it is missing or older than the source grid.
+    '''
+    try:
+        with open(bundle_dir / 'meta.json') as f:
+            meta = json.load(f)
+        if meta['source_mtime'] != source_mtime:
+            return None
+        return {name: np.load(bundle_dir / f'{name}.npy', mmap_mode='r') for name in ARRAYS}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def ref_grid() -> dict:
+    """
+    Returns the shared reference grid, building (and optionally persisting) it on first use.
+    In addition to the arrays from build_ref_grid, the dict holds 'swath', the
+    pyresample SwathDefinition of the wet cells used as the gridding target.
+    """
+    global _REF_GRID
+
+    if _REF_GRID is None:
+        ecco_path = REF_DIR / ECCO_FNAME
+        source_mtime = os.path.getmtime(ecco_path)
+
+        grid = load_bundle(BUNDLE_DIR, source_mtime) if PERSIST_REF_GRID else None
+        if grid is None:
+            logging.debug('Building reference grid')
+            grid = build_ref_grid(ecco_path)
+            if PERSIST_REF_GRID:
+                save_bundle(grid, BUNDLE_DIR, source_mtime)
+
+        grid['swath'] = pr.geometry.SwathDefinition(lons=np.asarray(grid['wet_lons']),
+                                                    lats=np.asarray(grid['wet_lats']))
+        _REF_GRID = grid
+
+    return _REF_GRID
+
+
+def build_coverage(wet_xyz, roi: float, res: float) -> np.ndarray:
+    """
+    Flags the cells of a regular res degree lat/lon lookup grid that could hold
+    along track points within roi meters of a wet target cell. Each lookup cell's
+    centre is tested against roi padded by the cell's extent, so no point within
+    roi of a wet cell is ever flagged as irrelevant.
+
+    Params:
+        wet_xyz (ndarray): cartesian coordinates of the wet target cells
+        roi (float): the gridding radius of influence in meters
+        res (float): lookup grid resolution in degrees
+
+    Returns:
+        coverage (ndarray): 2D boolean (lat, lon) lookup, starting at -90, -180
+    """
+    lat_centres = np.arange(-90, 90, res) + res / 2
+    lon_centres = np.arange(-180, 180, res) + res / 2
+    lon_m, lat_m = np.meshgrid(lon_centres, lat_centres)
+
+    margin = EARTH_RADIUS * np.deg2rad(res)
+    distances, _ = cKDTree(np.asarray(wet_xyz)).query(lonlat_to_xyz(lon_m.ravel(), lat_m.ravel()),
+                                                       distance_upper_bound=roi + margin)
+    return np.isfinite(distances).reshape(lon_m.shape)
+
+
+def coverage(roi: float, res: float = COVERAGE_RES) -> np.ndarray:
+    '''
+    The shared coverage lookup for a radius of influence, built (and optionally persisted) on first use
+    '''
+    key = (roi, res)
+    if key not in _COVERAGE:
+        grid = ref_grid()
+        path = BUNDLE_DIR / f'coverage_{int(roi)}m_{res}deg.npy'
+
+        lookup = None
+        if PERSIST_REF_GRID and path.exists() and \
+                os.path.getmtime(path) >= os.path.getmtime(BUNDLE_DIR / 'meta.json'):
+            lookup = np.load(path, mmap_mode='r')
+        if lookup is None:
+            logging.debug(f'Building coverage lookup for roi={roi}')
+            lookup = build_coverage(grid['wet_xyz'], roi, res)
+            if PERSIST_REF_GRID:
+                np.save(path, lookup)
+        _COVERAGE[key] = lookup
+
+    return _COVERAGE[key]
+
+
+def within_coverage(lons, lats, lookup, res: float = COVERAGE_RES) -> np.ndarray:
+    '''
+    Boolean mask of the points falling in flagged cells of a coverage lookup
+    '''
+    lons = np.mod(np.asarray(lons) + 180, 360)
+    lat_bins = np.clip(((np.asarray(lats) + 90) // res).astype(np.int64), 0, lookup.shape[0] - 1)
+    lon_bins = np.clip((lons // res).astype(np.int64), 0, lookup.shape[1] - 1)
+    return lookup[lat_bins, lon_bins]
+
+
+def ref_grid_dataset() -> xr.Dataset:
+    '''
+    The reference grid mask and area as a Dataset, for label based selection
+    '''
+    grid = ref_grid()
+    return xr.Dataset(
+        data_vars=dict(
+            mask=(['latitude', 'longitude'], np.asarray(grid['mask'])),
+            area=(['latitude', 'longitude'], np.asarray(grid['area']))
+        ),
+        coords={'latitude': np.asarray(grid['lat']), 'longitude': np.asarray(grid['lon'])}
+    )
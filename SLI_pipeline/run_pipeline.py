@@ -10,7 +10,8 @@ import yaml
 import txt_engine
 import upload_indicators
 from conf.global_settings import OUTPUT_DIR
-from cycle_gridding import cycle_gridding
+from cycle_gridding import affected_cycles, cycle_gridding, cycle_window, manifest_path
+from granule_catalog import open_catalog, pending_dates
 from harvester import harvester
 from indicators import indicators
 from logs.logconfig import configure_logging
@@ -35,6 +36,9 @@ def create_parser():
     parser.add_argument('--options_menu', default=False, action='store_true',
                         help='Display option menu to select which steps in the pipeline to run.')
 
+    parser.add_argument('--refresh_listings', default=False, action='store_true',
+                        help='Relist every remote year directory instead of using cached listings.')
+
     # parser.add_argument('-h', '--harvest', type=str, default='', dest='harvest_dataset',
     #                 help='Dataset to harvest. If no dataset given, will harvest all.')
     # parser.add_argument('-gc', '--grid_cycles', type=str, default='', dest='grid_cycles',
@@ -67,7 +71,7 @@ def show_menu():
             f'Unknown option entered, "{selection}", please enter a valid option\n')
 
 
-def run_harvester(datasets, configs, output_dir):
+def run_harvester(datasets, configs, output_dir, refresh_listings=False):
     """
         Calls the harvester with the dataset specific config file path for each
         dataset in datasets.
@@ -75,24 +79,78 @@ def run_harvester(datasets, configs, output_dir):
         Parameters:
             datasets (List[str]): A list of dataset names.
             output_dir (Path): The path to the output directory.
+            refresh_listings (bool): Relist remote directories instead of using cached listings.
     """
     for ds in datasets:
         try:
             ds_config = configs[ds]
-            status = harvester(ds_config, output_dir)
+            status = harvester(ds_config, output_dir, refresh_listings)
             logging.info(f'{ds} harvesting complete. {status}')
         except Exception as e:
             logging.exception(f'{ds} harvesting failed. {e}')
 
 
-def run_cycle_gridding(output_dir):
+def run_cycle_gridding(output_dir, dates=None):
     try:
-        cycle_gridding(output_dir)
+        cycle_gridding(output_dir, dates=dates)
         logging.info('Cycle gridding complete.')
     except Exception as e:
         logging.exception(f'Cycle gridding failed. {e}')
 
 
+def dataset_covers(config, cycle) -> bool:
+    '''
+    Checks if a dataset's configured date range overlaps a cycle's window
+    '''
+    cycle_start, cycle_end = [str(d).replace('-', '') for d in cycle_window(cycle)]
+    return config['start'] <= cycle_end and (config['end'] == 'now' or config['end'] >= cycle_start)
+
+
+def pending_cycles(output_dir) -> set:
+    '''
+    The cycles touched by granule changes not gridded yet, including changes
+    harvested by earlier runs and cycles whose gridding failed
+    '''
+    catalog = open_catalog(output_dir)
+    dates = pending_dates(catalog)
+    catalog.close()
+    return set(affected_cycles(dates))
+
+
+def run_harvest_and_gridding(datasets, configs, output_dir, refresh_listings=False):
+    """
+        Harvests each dataset in turn, and grids the pending cycles (see pending_cycles)
+        as soon as no dataset still to be harvested covers them. Without a gridded
+        cycles manifest, every cycle is checked once harvesting is done.
+
+        Parameters:
+            datasets (List[str]): A list of dataset names, in harvesting order.
+            configs (dict): The dataset configs by name.
+            output_dir (Path): The path to the output directory.
+            refresh_listings (bool): Relist remote directories instead of using cached listings.
+    """
+    full_scan = not manifest_path(output_dir).exists()
+
+    # Cycles are gridded at most once a run, so failing cycles wait for the next one
+    gridded = set()
+
+    for i, ds in enumerate(datasets):
+        run_harvester([ds], configs, output_dir, refresh_listings)
+        if full_scan:
+            continue
+
+        remaining = [configs[d] for d in datasets[i + 1:]]
+        ready = sorted(c for c in pending_cycles(output_dir) - gridded
+                       if not any(dataset_covers(cfg, c) for cfg in remaining))
+        if ready:
+            logging.info(f'Gridding {len(ready)} cycles affected by harvested granules')
+            run_cycle_gridding(output_dir, ready)
+            gridded.update(ready)
+
+    if full_scan:
+        run_cycle_gridding(output_dir)
+
+
 def run_indexing(output_dir) -> bool:
     success = False
     try:
@@ -144,16 +202,14 @@ if __name__ == '__main__':
 
     # Run harvesting, gridding, indexing, post processing
     if CHOSEN_OPTION == '1':
-        for dataset in DATASET_NAMES:
-            run_harvester([dataset], configs, OUTPUT_DIR)
-        run_cycle_gridding(OUTPUT_DIR)
+        run_harvest_and_gridding(DATASET_NAMES, configs, OUTPUT_DIR, args.refresh_listings)
         if run_indexing(OUTPUT_DIR):
-            run_post_processing()
+            run_post_processing(OUTPUT_DIR)
 
     # Run all harvesters
     elif CHOSEN_OPTION == '2':
         for dataset in DATASET_NAMES:
-            run_harvester([dataset], configs, OUTPUT_DIR)
+            run_harvester([dataset], configs, OUTPUT_DIR, args.refresh_listings)
 
     # Run specific harvester
     elif CHOSEN_OPTION == '3':
@@ -174,7 +230,7 @@ if __name__ == '__main__':
         CHOSEN_DS = ds_dict[int(ds_index)]
         logging.info(f'\nHarvesting {CHOSEN_DS} dataset')
 
-        run_harvester([CHOSEN_DS], configs, OUTPUT_DIR)
+        run_harvester([CHOSEN_DS], configs, OUTPUT_DIR, args.refresh_listings)
 
     # Run gridding
     elif CHOSEN_OPTION == '4':
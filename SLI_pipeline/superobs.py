@@ -0,0 +1,52 @@
+import numpy as np
+
+
+def bin_superobs(ssha_nn_obj, bin_size):
+    """
+    Collapses along track points into superobservations on a regular lat/lon bin grid.
+    Each occupied bin becomes one point at the mean position of its values, carrying
+    the sum, count and mean of ssha and the mean time.
+
+    Params:
+        ssha_nn_obj (dict): along track lat, lon, ssha and (optionally) time values
+        bin_size (float): bin width in degrees
+
+    Returns:
+        superobs_obj (dict): lat, lon, ssha (bin mean), sum, counts and time of each bin
+    """
+    lons = np.mod(ssha_nn_obj['lon'] + 180, 360) - 180
+    lats = ssha_nn_obj['lat']
+
+    n_lon = int(np.ceil(360 / bin_size))
+    lat_bins = np.floor((lats + 90) / bin_size).astype(np.int64)
+    lon_bins = np.minimum(np.floor((lons + 180) / bin_size).astype(np.int64), n_lon - 1)
+
+    _, inverse = np.unique(lat_bins * n_lon + lon_bins, return_inverse=True)
+    inverse = inverse.ravel()
+
+    counts = np.bincount(inverse)
+    ssha_sum = np.bincount(inverse, weights=ssha_nn_obj['ssha'])
+
+    superobs_obj = {
+        'lat': np.bincount(inverse, weights=lats) / counts,
+        'lon': np.bincount(inverse, weights=lons) / counts,
+        'ssha': ssha_sum / counts,
+        'sum': ssha_sum,
+        'counts': counts
+    }
+
+    if 'time' in ssha_nn_obj:
+        superobs_obj['time'] = np.bincount(inverse, weights=ssha_nn_obj['time']) / counts
+
+    return superobs_obj
+
+
+def superobs_error(binned_vals, full_vals):
+    '''
+    RMS and max absolute difference between grids made with and without superobservations
+    '''
+    diff = binned_vals - full_vals
+    valid = ~np.isnan(diff)
+    if not np.any(valid):
+        return np.nan, np.nan
+    return float(np.sqrt(np.mean(diff[valid] ** 2))), float(np.max(np.abs(diff[valid])))
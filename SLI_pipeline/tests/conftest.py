@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The pipeline modules are imported flat, as run_pipeline does
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,58 @@
+import warnings
+
+import numpy as np
+import pytest
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', UserWarning)
+    import pyresample as pr
+    from pyresample.kd_tree import resample_gauss
+
+from gauss_kdtree import gauss_grid_kdtree, lonlat_to_xyz
+
+PARAMS = {'roi': 6e5, 'sigma': 1e5, 'neighbours': 50}
+
+
+def synthetic_swath(n=20000, seed=0):
+    '''
+    Random along track points and a 1 degree target grid over part of the Pacific
+    '''
+    rng = np.random.default_rng(seed)
+    lons = rng.uniform(150, 250, n)
+    lats = rng.uniform(-30, 30, n)
+    values = 0.1 * np.sin(np.deg2rad(lats) * 3) + rng.normal(0, 0.02, n)
+
+    # Targets extend past the points so some cells have no neighbours
+    target_lons, target_lats = np.meshgrid(np.arange(140.5, 260), np.arange(-39.5, 40))
+    return lons, lats, values, target_lons.ravel(), target_lats.ravel()
+
+
+@pytest.mark.parametrize('neighbours', [10, 50])
+def test_kdtree_matches_resample_gauss(neighbours):
+    lons, lats, values, target_lons, target_lats = synthetic_swath()
+    params = {**PARAMS, 'neighbours': neighbours}
+
+    # pyresample wants longitudes in [-180, 180)
+    wrapped_lons = np.where(lons >= 180, lons - 360, lons)
+    wrapped_target_lons = np.where(target_lons >= 180, target_lons - 360, target_lons)
+
+    expected, _, expected_counts = resample_gauss(
+        pr.geometry.SwathDefinition(lons=wrapped_lons, lats=lats), values,
+        pr.geometry.SwathDefinition(lons=wrapped_target_lons, lats=target_lats),
+        radius_of_influence=params['roi'], sigmas=params['sigma'], fill_value=np.nan,
+        neighbours=params['neighbours'], with_uncert=True)
+
+    result, counts = gauss_grid_kdtree(lons, lats, values,
+                                       lonlat_to_xyz(target_lons, target_lats), params)
+
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_array_equal(counts, expected_counts)
+    np.testing.assert_allclose(result, expected, rtol=1e-6, atol=1e-9, equal_nan=True)
+
+
+def test_empty_swath_gives_nan():
+    target_xyz = lonlat_to_xyz(np.array([0.0, 10.0]), np.array([0.0, 10.0]))
+    result, counts = gauss_grid_kdtree(np.array([]), np.array([]), np.array([]), target_xyz, PARAMS)
+
+    assert np.all(np.isnan(result))
+    assert np.all(counts == 0)
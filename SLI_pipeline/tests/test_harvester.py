@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+
+import pytest
+
+import harvester
+from webdav_standin import drive_client, make_granules, serve_drive
+
+CONFIG = {'ds_name': 'ENVISAT_1', 'start': '20020101', 'end': '20031231'}
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    '''
+    Two years of ENVISAT_1 granules served by a local stand-in for the drive. Granules
+    are large enough that an interrupted download has saved part of one.
+    '''
+    granules = make_granules(tmp_path / 'drive', 'envisat-1', 'ENVISAT-1', [2002, 2003], n=6, size=300000)
+    server = serve_drive(tmp_path / 'drive', latency=0.01)
+
+    monkeypatch.setattr(harvester, 'drive_connection', lambda: drive_client(server))
+    monkeypatch.setattr(harvester, '_THREAD_CLIENTS', threading.local())
+    monkeypatch.setattr(harvester, 'RETRY_BACKOFF', 0)
+
+    yield server, granules
+    server.shutdown()
+
+
+def local_granule(target_dir, granule):
+    return target_dir / granule.parent.name / granule.name.split('_')[-1]
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_harvest_downloads_every_granule(drive, tmp_path, workers):
+    server, granules = drive
+    target_dir = tmp_path / 'ENVISAT_1' / 'harvested_granules'
+
+    stats = harvester.podaac_drive_harvester(CONFIG, target_dir, workers=workers)
+
+    assert stats['expected_files'] == len(granules)
+    for granule in granules:
+        assert local_granule(target_dir, granule).read_bytes() == granule.read_bytes()
+    assert not list(target_dir.glob('*/*.part'))
+
+    # Nothing is downloaded again once the granules are up to date
+    gets = len(server.gets)
+    harvester.podaac_drive_harvester(CONFIG, target_dir, workers=workers)
+    assert len(server.gets) == gets
+
+
+
+def test_interrupted_downloads_resume(drive, tmp_path):
+    server, granules = drive
+    target_dir = tmp_path / 'ENVISAT_1' / 'harvested_granules'
+    server.interrupt.update(g.name for g in granules[:3])
+
+    harvester.podaac_drive_harvester(CONFIG, target_dir, workers=4)
+
+    for granule in granules:
+        assert local_granule(target_dir, granule).read_bytes() == granule.read_bytes()
+    assert sorted(path.split('/')[-1] for path in server.ranges) == sorted(g.name for g in granules[:3])
+
+
+def remote_entry(server, granule) -> dict:
+    files = drive_client(server).list(f'envisat-1/{granule.parent.name}/', get_info=True)
+    return next(f for f in files if f['path'].endswith(granule.name))
+
+
+def replace_granule(granule) -> bytes:
+    '''
+    Replaces a remote granule with another of the same size and a later modified time
+    '''
+    data = bytes(b ^ 1 for b in granule.read_bytes())
+    granule.write_bytes(data)
+    later = time.time() + 10
+    os.utime(granule, (later, later))
+    return data
+
+
+@pytest.mark.parametrize('relisted', [True, False])
+def test_replaced_granule_is_not_resumed(drive, tmp_path, relisted):
+    server, granules = drive
+    granule = granules[0]
+    remote_path = f'envisat-1/{granule.parent.name}/{granule.name}'
+    local_fp = tmp_path / granule.name
+    old = remote_entry(server, granule)
+
+    server.interrupt.add(granule.name)
+    assert not harvester.download_granule(remote_path, local_fp, int(old['size']),
+                                          modified=old['modified'], retries=0)
+    assert local_fp.with_name(local_fp.name + '.part').exists()
+
+    data = replace_granule(granule)
+
+    # Relisted, the saved version no longer matches. With a cached listing, If-Range catches it.
+    entry = remote_entry(server, granule) if relisted else old
+    assert harvester.download_granule(remote_path, local_fp, int(entry['size']),
+                                      modified=entry['modified'], retries=0)
+    assert local_fp.read_bytes() == data
+    assert not server.ranges
+
+
+def test_complete_part_of_replaced_granule_is_discarded(drive, tmp_path):
+    server, granules = drive
+    granule = granules[0]
+    remote_path = f'envisat-1/{granule.parent.name}/{granule.name}'
+    local_fp = tmp_path / granule.name
+
+    # A whole old version, downloaded but never renamed into place
+    part_fp = local_fp.with_name(local_fp.name + '.part')
+    part_fp.write_bytes(granule.read_bytes())
+    harvester.part_version_path(part_fp).write_text(remote_entry(server, granule)['modified'])
+
+    data = replace_granule(granule)
+    entry = remote_entry(server, granule)
+    assert harvester.download_granule(remote_path, local_fp, int(entry['size']),
+                                      modified=entry['modified'], retries=0)
+    assert local_fp.read_bytes() == data
+    assert not part_fp.exists()
@@ -0,0 +1,162 @@
+"""
+A local stand-in for the PODAAC drive, for testing and benchmarking the harvester
+without network access. It answers the PROPFIND listings and (ranged) GETs the
+harvester makes, from a directory of fake granules and .md5 sidecars. Like the
+drive, it only honours a Range whose If-Range matches the file's modified time.
+"""
+import email.utils
+import hashlib
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+import numpy as np
+from webdav3.client import Client
+
+# Path the drive is served under. Hrefs include it, except a directory's own entry
+# in its listing, so like the drive's, each listing starts with the directory itself.
+MOUNT = '/int'
+
+
+class DriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def local_path(self) -> Path:
+        path = unquote(self.path.split('?')[0])
+        return self.server.root / path[len(MOUNT):].lstrip('/')
+
+    def empty_response(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PROPFIND(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.server.latency)
+
+        path = self.local_path()
+        if not path.exists():
+            return self.empty_response(404)
+
+        entries = [path] + (sorted(path.iterdir()) if path.is_dir() else [])
+        responses = []
+        for entry in entries:
+            href = '/' + entry.relative_to(self.server.root).as_posix().lstrip('.')
+            if not (entry == path and entry.is_dir()):
+                href = MOUNT + href
+            stat = entry.stat()
+            modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+            if entry.is_dir():
+                href = href.rstrip('/') + '/'
+                resource_type = '<d:resourcetype><d:collection/></d:resourcetype>'
+                size = 0
+            else:
+                resource_type = '<d:resourcetype/>'
+                size = stat.st_size
+            responses.append(
+                f'<d:response><d:href>{quote(href)}</d:href><d:propstat><d:prop>{resource_type}'
+                f'<d:getlastmodified>{modified}</d:getlastmodified>'
+                f'<d:getcontentlength>{size}</d:getcontentlength>'
+                f'<d:getetag>"{stat.st_mtime_ns}-{size}"</d:getetag>'
+                f'</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>')
+
+        body = ('<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:">' +
+                ''.join(responses) + '</d:multistatus>').encode()
+        self.send_response(207)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        path = self.local_path()
+        if not path.is_file():
+            return self.empty_response(404)
+
+        with self.server.lock:
+            self.server.gets.append(self.path)
+        data = path.read_bytes()
+        modified = email.utils.formatdate(path.stat().st_mtime, usegmt=True)
+
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range', modified) == modified:
+            with self.server.lock:
+                self.server.ranges.append(self.path)
+            start = int(byte_range[len('bytes='):].split('-')[0])
+            data = data[start:]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{start + len(data) - 1}/{path.stat().st_size}')
+        else:
+            self.send_response(200)
+        self.send_header('Last-Modified', modified)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        # Drop the connection a third of the way through granules set to be interrupted
+        with self.server.lock:
+            interrupt = path.name in self.server.interrupt
+            self.server.interrupt.discard(path.name)
+        if interrupt:
+            self.wfile.write(data[:len(data) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+
+        self.wfile.write(data)
+
+
+def serve_drive(root: Path, latency: float = 0) -> ThreadingHTTPServer:
+    """
+    Serves root as the drive from a background thread. The server records the
+    paths of its GET and honoured ranged GET requests in 'gets' and 'ranges', and cuts
+    short the next download of each granule name added to 'interrupt'.
+
+    Params:
+        root (Path): the directory holding the dataset directories
+        latency (float): seconds each request waits before it is answered
+
+    Returns:
+        server (ThreadingHTTPServer): the running server, stopped with shutdown()
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DriveHandler)
+    server.daemon_threads = True
+    server.root = Path(root)
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.gets = []
+    server.ranges = []
+    server.interrupt = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def drive_client(server: ThreadingHTTPServer) -> Client:
+    return Client({'webdav_hostname': f'http://127.0.0.1:{server.server_port}',
+                   'webdav_root': MOUNT, 'disable_check': True})
+
+
+def make_granules(root: Path, ds_dir: str, prefix: str, years, n: int, size: int, seed: int = 0) -> list:
+    '''
+    Writes n random granules and their .md5 sidecars for each year, starting June 1st
+    '''
+    rng = np.random.default_rng(seed)
+    paths = []
+    for year in years:
+        year_dir = Path(root) / ds_dir / str(year)
+        year_dir.mkdir(parents=True, exist_ok=True)
+        for day in np.arange(f'{year}-06-01', f'{year}-12-31', dtype='datetime64[D]')[:n]:
+            path = year_dir / f'{prefix}-alt_ssh{str(day).replace("-", "")}.h5'
+            data = rng.bytes(size)
+            path.write_bytes(data)
+            (year_dir / f'{path.name}.md5').write_text(f'{hashlib.md5(data).hexdigest()}  {path.name}\n')
+            paths.append(path)
+    return paths